@@ -0,0 +1,235 @@
+# coding=utf-8
+import glob
+import gzip
+import json
+import os.path
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from registry_parser import parse_document
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SAMPLES = [
+    os.path.join(ROOT, "samples", "sample1.json.gz2"),
+    os.path.join(ROOT, "samples", "sample2.json.gz2"),
+] + sorted(glob.glob(os.path.join(ROOT, "samples", "bug_sample*.json.gz")))
+DEFAULT_REFERENCE_DIR = os.path.join(ROOT, "parsing_results")
+
+# Flag texts are re.escape()d literals, and re.escape escapes less since
+# python 3.7, so they are compared unescaped unless strict is requested
+_unescape_regex = re.compile(r"\\(.)")
+
+
+def reference_name(infile):
+    # samples/bug_sample6.json.gz -> parsing_results/sample6
+    name = os.path.basename(infile).split(".", 1)[0]
+    if name.startswith("bug_"):
+        name = name[len("bug_") :]
+
+    return name
+
+
+def reference_path(reference_dir, name, doc):
+    for fname in [
+        "{}.json".format(doc["notice_id"]),
+        "{}_{}.json".format(doc["notice_id"], doc.get("federal_state")),
+    ]:
+        path = os.path.join(reference_dir, name, fname)
+        if os.path.exists(path):
+            return path
+
+    return None
+
+
+def normalize(parsed, strict=False):
+    # same roundtrip as the json files written by pipeline.py parse
+    parsed = json.loads(json.dumps(parsed, sort_keys=True, default=str))
+
+    if not strict:
+        for flag in parsed.get("flags", []):
+            if isinstance(flag, dict) and isinstance(flag.get("text"), str):
+                flag["text"] = _unescape_regex.sub(r"\1", flag["text"])
+
+    return parsed
+
+
+def diff_values(expected, got, path=""):
+    if isinstance(expected, dict) and isinstance(got, dict):
+        for k in sorted(set(expected) | set(got)):
+            sub_path = "{}.{}".format(path, k) if path else k
+            if k not in expected:
+                yield sub_path, "unexpected", None, got[k]
+            elif k not in got:
+                yield sub_path, "missing", expected[k], None
+            else:
+                yield from diff_values(expected[k], got[k], sub_path)
+    elif isinstance(expected, list) and isinstance(got, list):
+        for i in range(max(len(expected), len(got))):
+            sub_path = "{}[{}]".format(path, i)
+            if i >= len(expected):
+                yield sub_path, "unexpected", None, got[i]
+            elif i >= len(got):
+                yield sub_path, "missing", expected[i], None
+            else:
+                yield from diff_values(expected[i], got[i], sub_path)
+    elif expected != got:
+        yield path, "changed", expected, got
+
+
+def field_name(path):
+    # officers[3].payload.dob -> officers[].payload.dob
+    return re.sub(r"\[\d+\]", "[]", path)
+
+
+def check_chunk(task):
+    infile, first_line, lines, reference_dir, strict, update = task
+    name = reference_name(infile)
+    totals = Counter()
+    fields = Counter()
+    examples = []
+    updates = []
+
+    for line_no, l in enumerate(lines, first_line):
+        doc = json.loads(l)
+        parsing_result, p_doc = parse_document(doc)
+        totals["notices"] += 1
+
+        if update:
+            updates.append(
+                (
+                    os.path.join(
+                        reference_dir, name, "{}.json".format(doc["notice_id"])
+                    ),
+                    json.dumps(
+                        {"orig": p_doc, "parsed": parsing_result},
+                        indent=4,
+                        ensure_ascii=False,
+                        sort_keys=True,
+                        default=str,
+                    ),
+                )
+            )
+            totals["updated"] += 1
+            continue
+
+        path = reference_path(reference_dir, name, doc)
+        if path is None:
+            totals["no_reference"] += 1
+            continue
+
+        with open(path, "r") as fp:
+            reference = json.load(fp)
+
+        # references are keyed by notice_id, so when the notice_id repeats in a
+        # sample only the last record has its output on disk
+        if reference["orig"] != json.loads(json.dumps(p_doc, default=str)):
+            totals["shadowed"] += 1
+            continue
+
+        discrepancies = list(
+            diff_values(
+                normalize(reference["parsed"], strict),
+                normalize(parsing_result, strict),
+            )
+        )
+
+        if not discrepancies:
+            totals["identical"] += 1
+            continue
+
+        totals["different"] += 1
+        for path, kind, expected, got in discrepancies:
+            totals["discrepancies"] += 1
+            fields["{} ({})".format(field_name(path), kind)] += 1
+
+            examples.append(
+                {
+                    "infile": os.path.relpath(infile, ROOT),
+                    "line": line_no,
+                    "notice_id": doc["notice_id"],
+                    "path": path,
+                    "kind": kind,
+                    "expected": expected,
+                    "got": got,
+                }
+            )
+
+    return name, totals, fields, examples, updates
+
+
+def iter_tasks(infiles, reference_dir, strict, update, chunk_size):
+    for infile in infiles:
+        if update:
+            os.makedirs(
+                os.path.join(reference_dir, reference_name(infile)), exist_ok=True
+            )
+
+        with gzip.open(infile, "rt") as fp:
+            first_line = 0
+            while True:
+                lines = list(islice(fp, chunk_size))
+                if not lines:
+                    break
+
+                yield infile, first_line, lines, reference_dir, strict, update
+                first_line += len(lines)
+
+
+def run_golden(
+    infiles,
+    reference_dir=DEFAULT_REFERENCE_DIR,
+    num_of_workers=None,
+    strict=False,
+    update=False,
+    chunk_size=250,
+):
+    report = {"totals": Counter(), "samples": {}, "fields": Counter(), "examples": []}
+    tasks = iter_tasks(infiles, reference_dir, strict, update, chunk_size)
+
+    with ProcessPoolExecutor(max_workers=num_of_workers) as executor:
+        for name, totals, fields, examples, updates in executor.map(check_chunk, tasks):
+            # written in input order, so the last record wins as in pipeline.py
+            for path, content in updates:
+                with open(path, "w") as fp:
+                    fp.write(content)
+
+            report["totals"].update(totals)
+            report["samples"].setdefault(name, Counter()).update(totals)
+            report["fields"].update(fields)
+            report["examples"].extend(examples)
+
+    return report
+
+
+def format_golden_report(report, max_examples=20):
+    lines = []
+    for name, totals in sorted(report["samples"].items()):
+        lines.append(
+            "{}: {}".format(
+                name, ", ".join("{}={}".format(k, v) for k, v in sorted(totals.items()))
+            )
+        )
+
+    lines.append(
+        "total: {}".format(
+            ", ".join("{}={}".format(k, v) for k, v in sorted(report["totals"].items()))
+        )
+    )
+
+    if report["fields"]:
+        lines.append("discrepancies per field:")
+        for field, cnt in report["fields"].most_common():
+            lines.append("  {:>6}  {}".format(cnt, field))
+
+    for example in report["examples"][:max_examples]:
+        lines.append(
+            "{infile}:{line} notice {notice_id}, {path} {kind}: "
+            "expected {expected!r}, got {got!r}".format(**example)
+        )
+
+    if len(report["examples"]) > max_examples:
+        lines.append("... and {} more".format(len(report["examples"]) - max_examples))
+
+    return "\n".join(lines)
@@ -0,0 +1,82 @@
+# coding=utf-8
+import json
+import sys
+import time
+
+from benchmarks.throughput import read_lines
+from registry_parser import parse_document
+from workers import SupervisedPool, worker_context
+
+
+def parse_line(l):
+    return parse_document(json.loads(l))
+
+
+def process_memory(pid):
+    # USS is what a worker does not share with anybody else, PSS splits the
+    # shared pages evenly between the processes mapping them
+    mem = {}
+    try:
+        with open("/proc/{}/smaps_rollup".format(pid), "r") as fp:
+            for l in fp:
+                parts = l.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    mem[parts[0].rstrip(":")] = int(parts[1])
+    except OSError:
+        return None
+
+    return {
+        "rss_kb": mem.get("Rss"),
+        "pss_kb": mem.get("Pss"),
+        "uss_kb": mem.get("Private_Clean", 0) + mem.get("Private_Dirty", 0),
+    }
+
+
+def measure_startup(lines, start_method, num_of_workers):
+    def on_failure(index, item, error):
+        raise RuntimeError(error)
+
+    started = time.perf_counter()
+    pool = SupervisedPool(
+        parse_line,
+        num_of_workers,
+        on_failure,
+        batch_size=1,
+        mp_context=worker_context(start_method),
+    )
+
+    try:
+        # every idle worker gets one of those right away
+        list(pool.imap(lines[:num_of_workers]))
+        startup = time.perf_counter() - started
+
+        # workers have to touch the parser before their memory means anything
+        list(pool.imap(lines))
+        memory = [process_memory(w.process.pid) for w in pool.workers]
+    finally:
+        pool.close()
+
+    res = {
+        "start_method": start_method,
+        "workers": num_of_workers,
+        "startup_seconds": round(startup, 4),
+        "memory": memory,
+    }
+
+    if all(memory):
+        for k in ["rss_kb", "pss_kb", "uss_kb"]:
+            res["avg_" + k] = sum(m[k] for m in memory) // len(memory)
+
+    return res
+
+
+if __name__ == "__main__":
+    infile, start_method, num_of_workers = sys.argv[1:]
+    json.dump(
+        measure_startup(
+            read_lines([infile], limit=100 * int(num_of_workers)),
+            start_method,
+            int(num_of_workers),
+        ),
+        sys.stdout,
+    )
@@ -0,0 +1,306 @@
+# coding=utf-8
+import datetime
+import gzip
+import json
+import multiprocessing
+import os
+import os.path
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SAMPLES = [
+    os.path.join(ROOT, "samples", "sample1.json.gz2"),
+    os.path.join(ROOT, "samples", "sample2.json.gz2"),
+]
+
+# metrics (higher is better) that are compared against a previous run
+TRACKED_METRICS = ["notices_per_sec", "mb_per_sec"]
+
+
+def git_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_lines(infiles, limit=None):
+    lines = []
+    for infile in infiles:
+        with gzip.open(infile, "rt") as fp:
+            for l in fp:
+                lines.append(l)
+                if limit is not None and len(lines) >= limit:
+                    return lines
+
+    return lines
+
+
+def run_child(cmd):
+    # wait4 reports the peak RSS of the child and its reaped descendants. The
+    # peak is inherited over fork, so children are run before anything heavy
+    # gets loaded into this process
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    _, status, rusage = os.wait4(proc.pid, 0)
+    if os.WIFEXITED(status):
+        proc.returncode = os.WEXITSTATUS(status)
+    else:
+        proc.returncode = -os.WTERMSIG(status)
+    elapsed = time.perf_counter() - started
+
+    if proc.returncode != 0:
+        raise RuntimeError(
+            "{} exited with code {}".format(" ".join(cmd), proc.returncode)
+        )
+
+    return elapsed, rusage.ru_maxrss
+
+
+def rates(notices, num_bytes, seconds):
+    return {
+        "notices": notices,
+        "bytes": num_bytes,
+        "seconds": round(seconds, 4),
+        "notices_per_sec": round(notices / seconds, 2) if seconds else None,
+        "mb_per_sec": round(num_bytes / seconds / 2**20, 4) if seconds else None,
+    }
+
+
+def bench_import(repeat):
+    timings = []
+    peak_rss = 0
+    for _ in range(repeat):
+        elapsed, rss = run_child([sys.executable, "-c", "import registry_parser"])
+        timings.append(elapsed)
+        peak_rss = max(peak_rss, rss)
+
+    return {
+        "seconds_min": round(min(timings), 4),
+        "seconds_max": round(max(timings), 4),
+        "peak_rss_kb": peak_rss,
+    }
+
+
+def bench_single(lines):
+    from registry_parser import (
+        parse_document,
+        prepare_text,
+        sentence_cache,
+        split_sentences,
+    )
+
+    num_bytes = sum(len(l.encode("utf-8")) for l in lines)
+    stages = {}
+
+    started = time.perf_counter()
+    docs = [json.loads(l) for l in lines]
+    stages["decode"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    texts = [prepare_text(doc)[0] for doc in docs]
+    stages["prepare_text"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for text in texts:
+        split_sentences(text)
+    stages["split_sentences"] = time.perf_counter() - started
+
+    sentence_cache.clear()
+    started = time.perf_counter()
+    results = [parse_document(doc) for doc in docs]
+    parse_seconds = time.perf_counter() - started
+    stages["parse_document"] = parse_seconds
+    stages["sentence_rules"] = max(
+        0.0, parse_seconds - stages["prepare_text"] - stages["split_sentences"]
+    )
+
+    started = time.perf_counter()
+    for parsing_result, p_doc in results:
+        json.dumps(
+            {"orig": p_doc, "parsed": parsing_result},
+            ensure_ascii=False,
+            sort_keys=True,
+            default=str,
+        )
+    stages["encode"] = time.perf_counter() - started
+
+    res = rates(len(lines), num_bytes, parse_seconds)
+    res["stages"] = {
+        k: {"seconds": round(v, 4), "ms_per_notice": round(1000 * v / len(lines), 4)}
+        for k, v in stages.items()
+    }
+    res["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    res["sentence_cache"] = sentence_cache.info()
+
+    return res
+
+
+def bench_parallel(lines, workers, tmpdir):
+    infile = os.path.join(tmpdir, "input.json.gz")
+    with gzip.open(infile, "wt", compresslevel=1) as fp:
+        fp.writelines(lines)
+
+    num_bytes = sum(len(l.encode("utf-8")) for l in lines)
+    runs = []
+
+    for num_of_workers in workers:
+        outdir = tempfile.mkdtemp(dir=tmpdir)
+        elapsed, rss = run_child(
+            [
+                sys.executable,
+                os.path.join(ROOT, "pipeline.py"),
+                "parse",
+                infile,
+                outdir,
+                "--num_of_workers",
+                str(num_of_workers),
+                "--merge_results",
+            ]
+        )
+
+        res = rates(len(lines), num_bytes, elapsed)
+        res["workers"] = num_of_workers
+        res["peak_rss_kb"] = rss
+        runs.append(res)
+
+    return runs
+
+
+def bench_startup(infile, num_of_workers):
+    runs = []
+    for start_method in ["fork", "forkserver", "spawn"]:
+        if start_method not in multiprocessing.get_all_start_methods():
+            continue
+
+        out = subprocess.check_output(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.startup",
+                infile,
+                start_method,
+                str(num_of_workers),
+            ],
+            cwd=ROOT,
+            stderr=subprocess.DEVNULL,
+        )
+        runs.append(json.loads(out))
+
+    return runs
+
+
+def default_workers(max_workers):
+    workers = []
+    n = 1
+    while n < max_workers:
+        workers.append(n)
+        n *= 2
+
+    return workers + [max_workers]
+
+
+def run_benchmarks(infiles, max_workers, limit=None, repeat=3):
+    lines = read_lines(infiles, limit)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "inputs": [os.path.relpath(f, ROOT) for f in infiles],
+        "import": bench_import(repeat),
+    }
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        report["parallel"] = bench_parallel(lines, default_workers(max_workers), tmpdir)
+        report["startup"] = bench_startup(
+            os.path.join(tmpdir, "input.json.gz"), max_workers
+        )
+
+    report["single"] = bench_single(lines)
+
+    return report
+
+
+def compare_reports(old, new, tolerance):
+    regressions = []
+
+    def check(name, old_run, new_run):
+        for metric in TRACKED_METRICS:
+            old_value, new_value = old_run.get(metric), new_run.get(metric)
+            if not old_value or new_value is None:
+                continue
+
+            change = 100.0 * (new_value - old_value) / old_value
+            if change < -tolerance:
+                regressions.append(
+                    "{} {}: {} -> {} ({:+.1f}%)".format(
+                        name, metric, old_value, new_value, change
+                    )
+                )
+
+    check("single", old["single"], new["single"])
+
+    old_parallel = {r["workers"]: r for r in old.get("parallel", [])}
+    for run in new.get("parallel", []):
+        if run["workers"] in old_parallel:
+            check(
+                "parallel[{}]".format(run["workers"]),
+                old_parallel[run["workers"]],
+                run,
+            )
+
+    return regressions
+
+
+def format_report(report):
+    lines = [
+        "commit: {}".format(report["commit"]),
+        "import: {seconds_min}s (peak rss {peak_rss_kb} KB)".format(**report["import"]),
+        "parse_document: {notices_per_sec} notices/sec, {mb_per_sec} MB/sec "
+        "(peak rss {peak_rss_kb} KB)".format(**report["single"]),
+    ]
+
+    lines.append(
+        "  sentence cache: {hits} hits, {misses} misses, {size} entries".format(
+            **report["single"]["sentence_cache"]
+        )
+    )
+
+    for stage, timing in report["single"]["stages"].items():
+        lines.append(
+            "  {:<16} {:>10}s {:>10} ms/notice".format(
+                stage, timing["seconds"], timing["ms_per_notice"]
+            )
+        )
+
+    for run in report["parallel"]:
+        lines.append(
+            "parse x{workers}: {notices_per_sec} notices/sec, {mb_per_sec} MB/sec "
+            "(peak rss {peak_rss_kb} KB)".format(**run)
+        )
+
+    for run in report.get("startup", []):
+        lines.append(
+            "startup {start_method} x{workers}: {startup_seconds}s, per worker "
+            "uss {avg_uss_kb} KB, pss {avg_pss_kb} KB".format(
+                **dict({"avg_uss_kb": None, "avg_pss_kb": None}, **run)
+            )
+        )
+
+    return "\n".join(lines)
@@ -0,0 +1,181 @@
+# coding=utf-8
+import hashlib
+from collections import OrderedDict, deque
+
+from rawjson import RawRecord, probe, value_span
+
+# Parsing depends on event_type and full_text of a notice only, notices that
+# share both are parsed once and the result is reused for all of them
+
+
+def text_digest(l):
+    # of the raw values, a single dump escapes the same text the same way
+    h = hashlib.blake2b(digest_size=16)
+    for key in ["event_type", "full_text"]:
+        span = value_span(l, key)
+        h.update(l[span[0] : span[1]].encode("utf-8") if span else b"null")
+        h.update(b"\0")
+
+    return h.digest()
+
+
+class BloomFilter(object):
+    # set of digests in num_of_bits bits, with false positives but no false
+    # negatives
+    num_of_hashes = 7
+
+    def __init__(self, num_of_bits):
+        self.num_of_bits = num_of_bits
+        self.bits = bytearray((num_of_bits + 7) // 8)
+
+    def _positions(self, digest):
+        # double hashing on the two halves of the digest
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_of_bits for i in range(self.num_of_hashes)]
+
+    def add(self, digest):
+        for pos in self._positions(digest):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, digest):
+        return all(
+            self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(digest)
+        )
+
+
+class _Text(object):
+    # a text sent to the workers once, shared by its duplicates
+    __slots__ = ["digest", "done", "failed", "result", "duplicates"]
+
+    def __init__(self, digest):
+        self.digest = digest
+        self.done = False
+        self.failed = False
+        # (parsing_result, counts), None when the worker filtered it out
+        self.result = None
+        # (line_no, line) held back while the text is in flight
+        self.duplicates = []
+
+
+# Sits around the map of a parse run. filter() holds back notices whose text
+# is being parsed already or was parsed recently, collapse() hands out the
+# result of the text for each of them as well, with duplicate_text set in
+# its counts. A text that was seen but is neither in flight nor cached
+# (evicted, or a false positive of the bloom filter) is simply parsed again.
+#
+# Duplicates keep their place in the input: filter() queues a placeholder
+# for every line in order, and collapse() walks that queue along with the
+# ordered results of the map, so a duplicate is handed out only once all of
+# the lines before it are.
+class DuplicateCollapser(object):
+    cache_size = 10000
+
+    def __init__(self, output_fields, bloom_bits=None):
+        self.output_fields = output_fields
+        self.seen = BloomFilter(bloom_bits) if bloom_bits else set()
+        # digest -> _Text in flight
+        self.waiting = {}
+        # digest -> (parsing_result, counts), least recently used first
+        self.cache = OrderedDict()
+        # (line_no, _Text or None, line of a duplicate or None) of every line
+        # not handed out yet, in input order
+        self.order = deque()
+        # line numbers of lines sent to the map that failed there
+        self.failed_lines = set()
+        self.num_of_duplicates = 0
+
+    def filter(self, items, read=str):
+        # items are (line_no, item) pairs
+        for item in items:
+            line_no, l = item[0], read(item[1])
+            try:
+                digest = text_digest(l)
+            except ValueError:
+                # broken, left to the worker to report it
+                self.order.append((line_no, None, None))
+                yield item
+                continue
+
+            if digest in self.seen:
+                text = self.waiting.get(digest)
+                if text is None and digest in self.cache:
+                    self.cache.move_to_end(digest)
+                    text = _Text(digest)
+                    text.done = True
+                    text.result = self.cache[digest]
+
+                if text is not None:
+                    text.duplicates.append((line_no, l))
+                    self.order.append((line_no, text, l))
+                    self.num_of_duplicates += 1
+                    continue
+            else:
+                self.seen.add(digest)
+
+            text = self.waiting[digest] = _Text(digest)
+            self.order.append((line_no, text, None))
+            yield item
+
+    def duplicate(self, l, result):
+        parsing_result, counts = result
+        orig = RawRecord(l, {k: probe(l, k) for k in self.output_fields})
+        return parsing_result, orig, dict(counts, duplicate_text=1)
+
+    def failed(self, line_no, l):
+        # Called for a line of filter() that failed in the map. Returns the
+        # (line_no, line) of its duplicates, they fail all the same.
+        self.failed_lines.add(line_no)
+        try:
+            text = self.waiting.get(text_digest(l))
+        except ValueError:
+            return []
+
+        if text is None or text.done:
+            return []
+
+        del self.waiting[text.digest]
+        text.failed = True
+        return text.duplicates
+
+    def _release(self):
+        # hands out the lines at the front of the queue that need no result
+        # of the map, up to the next line that does
+        while self.order:
+            line_no, text, l = self.order[0]
+            if l is None:
+                if line_no not in self.failed_lines:
+                    break
+
+                self.failed_lines.discard(line_no)
+            elif text.done:
+                if text.result is None:
+                    # filtered out by the worker, like its original
+                    yield None
+                else:
+                    yield self.duplicate(l, text.result)
+            elif not text.failed:
+                break
+
+            self.order.popleft()
+
+    def collapse(self, results):
+        for res in results:
+            yield from self._release()
+
+            _, text, _ = self.order.popleft()
+            if text is not None:
+                text.done = True
+                if self.waiting.get(text.digest) is text:
+                    del self.waiting[text.digest]
+
+                if res is not None:
+                    parsing_result, _, counts = res
+                    text.result = parsing_result, counts
+                    self.cache[text.digest] = text.result
+                    if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+
+            yield res
+
+        yield from self._release()
@@ -0,0 +1,118 @@
+# coding=utf-8
+import gzip
+import hashlib
+import json
+import os.path
+
+from extsort import ExternalSorter, group_sorted
+from rawjson import probe
+
+# Difference between two dumps by notice: (notice_id, federal_state) and a
+# hash of full_text of every line are sorted on disk for both of them and
+# then merge joined, so memory is bounded by the run size of the sorters
+# plus the line numbers of the new and changed notices.
+
+STATUSES = ["new", "changed", "deleted", "unchanged"]
+
+
+def text_digest(full_text):
+    return hashlib.blake2b((full_text or "").encode("utf-8"), digest_size=16).digest()
+
+
+def line_record(l, line_no):
+    # ((notice_id, federal_state), digest, line_no), only the probed fields
+    # of the line are decoded
+    key = str(probe(l, "notice_id")), str(probe(l, "federal_state"))
+    return key, text_digest(probe(l, "full_text")), line_no
+
+
+def _record_key(record):
+    return record[0], record[2]
+
+
+def sorted_records(infile, run_size, tmpdir=None):
+    sorter = ExternalSorter(key=_record_key, run_size=run_size, tmpdir=tmpdir)
+    num_broken = 0
+
+    with gzip.open(infile, "rt") as fp:
+        for line_no, l in enumerate(fp):
+            try:
+                sorter.add(line_record(l, line_no))
+            except ValueError:
+                num_broken += 1
+
+    return sorter, num_broken
+
+
+def _latest(records):
+    # a notice repeated within a dump counts with its last line
+    groups = group_sorted(records, key=lambda record: record[0])
+    return ((key, group[-1]) for key, group in groups)
+
+
+def diff_records(old_records, new_records):
+    # (status, key, line_no in the new dump or None) for every notice of both
+    # dumps, ordered by key
+    old_itr = _latest(old_records)
+    new_itr = _latest(new_records)
+    old = next(old_itr, None)
+    new = next(new_itr, None)
+
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield "deleted", old[0], None
+            old = next(old_itr, None)
+        elif old is None or new[0] < old[0]:
+            yield "new", new[0], new[1][2]
+            new = next(new_itr, None)
+        else:
+            status = "unchanged" if old[1][1] == new[1][1] else "changed"
+            yield status, new[0], new[1][2]
+            old = next(old_itr, None)
+            new = next(new_itr, None)
+
+
+def write_diff(old_infile, new_infile, outdir, run_size=1000000, tmpdir=None):
+    # Writes changed.json.gz with the lines of new and changed notices, in
+    # the order of the new dump, ready to be parsed, and diff.jsonlines with
+    # the status of every notice that is not unchanged. Returns the counts.
+    counts = dict.fromkeys(STATUSES + ["broken"], 0)
+    wanted = set()
+
+    old_records, num_broken = sorted_records(old_infile, run_size, tmpdir)
+    counts["broken"] += num_broken
+    new_records, num_broken = sorted_records(new_infile, run_size, tmpdir)
+    counts["broken"] += num_broken
+
+    with old_records, new_records, open(
+        os.path.join(outdir, "diff.jsonlines"), "w"
+    ) as fp:
+        for status, key, line_no in diff_records(old_records, new_records):
+            counts[status] += 1
+            if status == "unchanged":
+                continue
+
+            if line_no is not None:
+                wanted.add(line_no)
+
+            fp.write(
+                "{}\n".format(
+                    json.dumps(
+                        {
+                            "notice_id": key[0],
+                            "federal_state": key[1],
+                            "status": status,
+                        },
+                        ensure_ascii=False,
+                    )
+                )
+            )
+
+    with gzip.open(new_infile, "rt") as f_in, gzip.open(
+        os.path.join(outdir, "changed.json.gz"), "wt", compresslevel=1
+    ) as f_out:
+        for line_no, l in enumerate(f_in):
+            if line_no in wanted:
+                f_out.write(l)
+
+    return counts
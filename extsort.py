@@ -0,0 +1,85 @@
+# coding=utf-8
+import heapq
+import pickle
+import tempfile
+
+
+class ExternalSorter(object):
+    def __init__(self, key=None, run_size=100000, tmpdir=None):
+        self.key = key
+        self.run_size = run_size
+        self.tmpdir = tmpdir
+        self.buffer = []
+        self.runs = []
+        self.num_records = 0
+
+    def add(self, record):
+        self.buffer.append(record)
+        self.num_records += 1
+
+        if len(self.buffer) >= self.run_size:
+            self._spill()
+
+    def _spill(self):
+        self.buffer.sort(key=self.key)
+        run = tempfile.TemporaryFile(dir=self.tmpdir)
+        pickler = pickle.Pickler(run, protocol=pickle.HIGHEST_PROTOCOL)
+
+        for record in self.buffer:
+            pickler.dump(record)
+            # records are independent, do not keep them in the memo
+            pickler.clear_memo()
+
+        run.seek(0)
+        self.runs.append(run)
+        self.buffer = []
+
+    @staticmethod
+    def _read_run(run):
+        # every record is loaded on its own, its memo indexes start over
+        # just like they did when it was dumped
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                break
+
+    def __iter__(self):
+        self.buffer.sort(key=self.key)
+
+        if not self.runs:
+            return iter(self.buffer)
+
+        return heapq.merge(
+            *[self._read_run(run) for run in self.runs], iter(self.buffer), key=self.key
+        )
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+
+        self.runs = []
+        self.buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def group_sorted(records, key):
+    group = []
+    group_key = None
+
+    for record in records:
+        k = key(record)
+        if group and k != group_key:
+            yield group_key, group
+            group = []
+
+        group_key = k
+        group.append(record)
+
+    if group:
+        yield group_key, group
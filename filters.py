@@ -0,0 +1,63 @@
+# coding=utf-8
+import datetime
+
+from rawjson import probe
+
+
+def date_spec(value):
+    # for argparse, posted_on is compared as a YYYY-MM-DD string
+    datetime.datetime.strptime(value, "%Y-%m-%d")
+    return value
+
+
+class NoticeFilter(object):
+    def __init__(self, federal_states=None, event_types=None, since=None, until=None):
+        self.federal_states = {x.lower() for x in federal_states or []}
+        self.event_types = {x.lower() for x in event_types or []}
+        self.since = since
+        self.until = until
+
+        self.keys = []
+        if self.federal_states:
+            self.keys.append("federal_state")
+        if self.event_types:
+            self.keys.append("event_type")
+        if since or until:
+            self.keys.append("posted_on")
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            federal_states=args.federal_state,
+            event_types=args.event_type,
+            since=args.since,
+            until=args.until,
+        )
+
+    def __bool__(self):
+        return bool(self.keys)
+
+    def check(self, key, value):
+        if key == "federal_state":
+            return str(value).lower() in self.federal_states
+
+        if key == "event_type":
+            return str(value).lower() in self.event_types
+
+        if not isinstance(value, str):
+            return False
+
+        return (self.since is None or value[:10] >= self.since) and (
+            self.until is None or value[:10] <= self.until
+        )
+
+    def matches_line(self, l):
+        # Only the probed values are decoded, never the whole line. Broken lines
+        # are let through, to be reported by the worker that fails on them
+        try:
+            return all(self.check(key, probe(l, key)) for key in self.keys)
+        except ValueError:
+            return True
+
+    def matches(self, doc):
+        return all(self.check(key, doc.get(key)) for key in self.keys)
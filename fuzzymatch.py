@@ -0,0 +1,227 @@
+# coding=utf-8
+import re
+import zlib
+
+from extsort import ExternalSorter, group_sorted
+from officerindex import normalise
+from registry_parser import FullPerson
+
+# Fuzzy matching of persons from the officers index. Candidate pairs come
+# from blocks of persons that share a blocking key, the keys are:
+#   ("p", Kölner Phonetik of lastname, of the first name, dob)
+#   ("g", trigram of lastname, dob), only for persons with a dob
+# Keys and pairs are sorted on disk, so memory is bounded by the persons
+# themselves. Blocks larger than max_block are skipped, they would not tell
+# anybody apart anyway.
+#
+# Pairs are scored on trigram signatures: every name is a 256 bit int with a
+# bit set per hashed trigram, so the similarity of two names is a couple of
+# bitwise operations instead of set arithmetic.
+
+SIGNATURE_BITS = 256
+
+_word_regex = re.compile(r"[a-z]+")
+
+# titles are split into words like the names are, "diplom-ingenieur (fh)"
+# has to go as diplom, ingenieur and fh
+TITLE_WORDS = set(_word_regex.findall(" ".join(FullPerson.titles))) | {
+    "dr",
+    "prof",
+    "dipl",
+    "ing",
+    "kfm",
+    "rer",
+    "nat",
+    "med",
+    "jur",
+}
+
+_codes = {}
+for _letters, _code in [
+    ("aeijouy", "0"),
+    ("b", "1"),
+    ("fvw", "3"),
+    ("gkq", "4"),
+    ("l", "5"),
+    ("mn", "6"),
+    ("r", "7"),
+    ("sz", "8"),
+]:
+    for _letter in _letters:
+        _codes[_letter] = _code
+
+
+# normalise() spells umlauts out, so Müller is mueller, but Muller is not
+_umlauts = [("ae", "a"), ("oe", "o"), ("ue", "u")]
+
+
+def name_words(value):
+    res = []
+    for w in _word_regex.findall(normalise(value)):
+        if w in TITLE_WORDS:
+            continue
+
+        for spelled, plain in _umlauts:
+            w = w.replace(spelled, plain)
+
+        res.append(w)
+
+    return res
+
+
+def _letter_code(word, i):
+    c = word[i]
+    prev = word[i - 1] if i else ""
+    nxt = word[i + 1] if i + 1 < len(word) else ""
+
+    if c == "h":
+        return ""
+
+    if c == "p":
+        return "3" if nxt == "h" else "1"
+
+    if c in "dt":
+        return "8" if nxt in ("c", "s", "z") else "2"
+
+    if c == "c":
+        if i == 0:
+            return "4" if nxt and nxt in "ahkloqrux" else "8"
+
+        return "4" if nxt and nxt in "ahkoqux" and prev not in ("s", "z") else "8"
+
+    if c == "x":
+        return "8" if prev in ("c", "k", "q") else "48"
+
+    return _codes.get(c, "")
+
+
+def koelner_phonetik(word):
+    # umlauts are folded by normalise() before, ae, oe and ue are vowels
+    # either way
+    digits = "".join(_letter_code(word, i) for i in range(len(word)))
+
+    code = []
+    for d in digits:
+        if not code or code[-1] != d:
+            code.append(d)
+
+    return code[0] + "".join(d for d in code[1:] if d != "0") if code else ""
+
+
+def phonetic(words):
+    return " ".join(koelner_phonetik(w) for w in words)
+
+
+def trigrams(words):
+    value = "#{}#".format(" ".join(words))
+    return {value[i : i + 3] for i in range(len(value) - 2)}
+
+
+def signature(words):
+    sig = 0
+    for gram in trigrams(words):
+        sig |= 1 << (zlib.crc32(gram.encode("utf-8")) % SIGNATURE_BITS)
+
+    return sig
+
+
+# int.bit_count is 3.10+, counting the ones of bin() is a lot slower
+if hasattr(int, "bit_count"):
+    _popcount = int.bit_count
+else:
+
+    def _popcount(value):
+        return bin(value).count("1")
+
+
+def similarity(a, b):
+    union = _popcount(a | b)
+    return _popcount(a & b) / union if union else 0.0
+
+
+class FuzzyMatcher(object):
+    lastname_weight = 0.6
+
+    def __init__(self, max_block=1000, run_size=1000000, tmpdir=None):
+        self.max_block = max_block
+        self.run_size = run_size
+        self.tmpdir = tmpdir
+        # person_id, lastname, name, dob of every person, by position
+        self.persons = []
+        self.lastname_signatures = []
+        self.name_signatures = []
+        self.keys = ExternalSorter(
+            key=lambda record: record[0], run_size=run_size, tmpdir=tmpdir
+        )
+        self.stats = {"persons": 0, "blocks": 0, "skipped_blocks": 0, "pairs": 0}
+
+    def blocking_keys(self, lastname, name, dob):
+        keys = [("p", phonetic(lastname), phonetic(name[:1]), dob)]
+        if dob:
+            keys.extend(("g", gram, dob) for gram in trigrams(lastname))
+
+        return keys
+
+    def add(self, person):
+        lastname = name_words(person["lastname"])
+        name = name_words(person["name"])
+        if not lastname:
+            return
+
+        index = len(self.persons)
+        dob = person.get("dob") or ""
+        self.persons.append(
+            (person["person_id"], person["lastname"], person["name"], dob)
+        )
+        self.lastname_signatures.append(signature(lastname))
+        self.name_signatures.append(signature(name))
+        self.stats["persons"] += 1
+
+        for key in self.blocking_keys(lastname, name, dob):
+            self.keys.add((key, index))
+
+    def candidate_pairs(self):
+        # unique (i, j) pairs with i < j, sorted
+        with ExternalSorter(run_size=self.run_size, tmpdir=self.tmpdir) as pairs:
+            for _, records in group_sorted(self.keys, key=lambda record: record[0]):
+                self.stats["blocks"] += 1
+                if len(records) > self.max_block:
+                    self.stats["skipped_blocks"] += 1
+                    continue
+
+                indexes = sorted(index for _, index in records)
+                for a in range(len(indexes)):
+                    for b in range(a + 1, len(indexes)):
+                        pairs.add((indexes[a], indexes[b]))
+
+            self.keys.close()
+
+            last = None
+            for pair in pairs:
+                if pair != last:
+                    self.stats["pairs"] += 1
+                    yield pair
+
+                last = pair
+
+    def score(self, i, j):
+        ls, ns = self.lastname_signatures, self.name_signatures
+        w = self.lastname_weight
+        return w * similarity(ls[i], ls[j]) + (1 - w) * similarity(ns[i], ns[j])
+
+    def matches(self, threshold):
+        # (person a, person b, score) of every candidate pair scored at or
+        # over threshold, best first. Pairs are ranked on disk like they are
+        # generated, ties go by position of the persons
+        with ExternalSorter(
+            key=lambda record: (-record[0], record[1], record[2]),
+            run_size=self.run_size,
+            tmpdir=self.tmpdir,
+        ) as ranked:
+            for i, j in self.candidate_pairs():
+                score = self.score(i, j)
+                if score >= threshold:
+                    ranked.add((score, i, j))
+
+            for score, i, j in ranked:
+                yield self.persons[i], self.persons[j], score
@@ -0,0 +1,150 @@
+# coding=utf-8
+import gzip
+import mmap
+import os
+import os.path
+import tempfile
+from array import array
+
+# Decompressed copy of a gzipped input file plus a sidecar with the offset of
+# every line, so that later runs can mmap it and workers can be sent (start,
+# end) spans instead of the lines themselves
+
+_mappings = {}
+
+
+def cache_path(infile, cache_dir):
+    # a new cache is built whenever the input file changes
+    st = os.stat(infile)
+    name = os.path.basename(infile).split(".", 1)[0]
+    return os.path.join(
+        cache_dir, "{}.{}.{}.jsonl".format(name, st.st_size, int(st.st_mtime))
+    )
+
+
+def offsets_path(path):
+    return path + ".offsets"
+
+
+def _temp_file(path):
+    # unique per process, concurrent runs building the same cache do not
+    # write into each other's files
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path)
+    )
+    # mkstemp creates the file readable by its owner only, a cache dir can be
+    # shared, so it gets the mode open() would have given it
+    umask = os.umask(0)
+    os.umask(umask)
+    os.fchmod(fd, 0o666 & ~umask)
+    return os.fdopen(fd, "wb"), tmp_path
+
+
+def build_cache(infile, path):
+    offsets = array("Q", [0])
+    tmp_paths = []
+
+    try:
+        f_out, tmp_path = _temp_file(path)
+        tmp_paths.append(tmp_path)
+        with gzip.open(infile, "rb") as f_in, f_out:
+            pos = 0
+            for l in f_in:
+                f_out.write(l)
+                pos += len(l)
+                offsets.append(pos)
+
+        fp, tmp_offsets_path = _temp_file(offsets_path(path))
+        tmp_paths.append(tmp_offsets_path)
+        with fp:
+            offsets.tofile(fp)
+
+        # The sidecar is renamed last, a cache without it is not complete.
+        # Whoever renames last wins, caches built from the same input are
+        # the same, and files already mapped by others stay valid.
+        os.replace(tmp_path, path)
+        os.replace(tmp_offsets_path, offsets_path(path))
+    finally:
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def open_cache(infile, cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(infile, cache_dir)
+
+    if not os.path.exists(offsets_path(path)):
+        build_cache(infile, path)
+
+    return InputCache(path)
+
+
+def mapping(path):
+    # every process maps the file once, the pages are shared via page cache
+    if path not in _mappings:
+        with open(path, "rb") as fp:
+            if os.fstat(fp.fileno()).st_size:
+                _mappings[path] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                _mappings[path] = b""
+
+    return _mappings[path]
+
+
+def read_span(path, span):
+    return mapping(path)[span[0] : span[1]].decode("utf-8")
+
+
+def span_size(span):
+    return span[1] - span[0]
+
+
+def read_blocks(fp, block_size):
+    # (number of the first line, bytes) of about block_size bytes each, cut
+    # after a newline, from a file opened in binary mode
+    line_no = 0
+    while True:
+        data = fp.read(block_size)
+        if not data:
+            break
+
+        data += fp.readline()
+        yield line_no, data
+        line_no += data.count(b"\n")
+
+
+def split_block(data):
+    lines = data.split(b"\n")
+    if not lines[-1]:
+        lines.pop()
+
+    return lines
+
+
+def block_bytes(block):
+    return len(block[1])
+
+
+class InputCache(object):
+    def __init__(self, path):
+        self.path = path
+        self.offsets = array("Q")
+
+        with open(offsets_path(path), "rb") as fp:
+            self.offsets.frombytes(fp.read())
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def spans(self):
+        offsets = self.offsets
+        for i in range(len(self)):
+            yield offsets[i], offsets[i + 1]
+
+    def read(self, span):
+        return read_span(self.path, span)
+
+    def __iter__(self):
+        for span in self.spans():
+            yield self.read(span)
@@ -0,0 +1,353 @@
+# coding=utf-8
+import glob
+import hashlib
+import json
+import os
+import os.path
+import re
+import unicodedata
+import zlib
+
+from rawjson import check_merged_files, merged_orig
+
+# Persistent index of the persons found in officers of parsed notices. A
+# person is identified by normalised (lastname, name, dob, city), its id is a
+# hash of those, so it stays the same across updates and rebuilds.
+#
+# Layout of an index dir:
+#   manifest.json               number of buckets and input files indexed
+#   buckets/bucket_00042.jsonl  persons, sorted by person_id, with all of
+#                               their appearances in notices
+#   delta/bucket_00042.jsonl    appearances added since the bucket was last
+#                               compacted, read along with it
+#   spill/bucket_00042.jsonl    appearances of the running update
+#
+# Persons go to buckets by (lastname, name), so a lookup without dob or city
+# has to read a single bucket only. An update spills the appearances of new
+# input files by bucket and appends them to the delta of the bucket, so its
+# I/O is proportional to the update. A bucket is compacted, rewritten with
+# its delta merged in, once the delta passes a share of the bucket size,
+# which keeps the cost of that amortised. Memory is bounded by the size of a
+# bucket, and files indexed before are never read again.
+DEFAULT_NUM_OF_BUCKETS = 256
+
+KEY_FIELDS = ["lastname", "name", "dob", "city"]
+# fields of the notice kept with every appearance
+NOTICE_FIELDS = [
+    "notice_id",
+    "federal_state",
+    "amtsgericht",
+    "aktenzeichen",
+    "name",
+    "posted_on",
+]
+
+_spaces_regex = re.compile(r"\s+")
+_folding = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+
+
+def normalise(value):
+    if value is None:
+        return ""
+
+    value = unicodedata.normalize("NFKC", str(value)).lower().translate(_folding)
+    return _spaces_regex.sub(" ", value).strip(" ,.;:")
+
+
+def person_key(payload):
+    return tuple(normalise(payload.get(f)) for f in KEY_FIELDS)
+
+
+def person_id(key):
+    return hashlib.sha1("\x1f".join(key).encode("utf-8")).hexdigest()[:16]
+
+
+def bucket_of(key, num_of_buckets):
+    return zlib.crc32("\x1f".join(key[:2]).encode("utf-8")) % num_of_buckets
+
+
+def appearances(merged_line):
+    # (key, appearance) for every officer of a line of merged.jsonlines that
+    # has a name at all
+    res = json.loads(merged_line)
+    orig = merged_orig(res)
+    notice = {f: orig.get(f) for f in NOTICE_FIELDS}
+    notice["company"] = notice.pop("name")
+
+    for i, officer in enumerate(res["parsed"].get("officers", [])):
+        payload = officer["payload"]
+        if not payload.get("lastname"):
+            continue
+
+        appearance = dict(notice)
+        appearance.update(
+            {
+                "officer_no": i,
+                "class": officer["class"],
+                "dismissed": bool(payload.get("dismissed")),
+            }
+        )
+        yield person_key(payload), appearance
+
+
+def _appearance_key(appearance):
+    return (
+        appearance["notice_id"],
+        appearance["federal_state"],
+        appearance["officer_no"],
+    )
+
+
+def _appearance_order(appearance):
+    return appearance["posted_on"] or "", appearance["notice_id"] or ""
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+class OfficerIndex(object):
+    # a delta is compacted into its bucket once it is larger than this share
+    # of the bucket, or than min_compact_bytes for small buckets
+    compact_ratio = 0.5
+    min_compact_bytes = 2**20
+
+    def __init__(self, path, num_of_buckets=None):
+        # num_of_buckets is fixed when the index is created, None takes the
+        # one of an existing index or the default for a new one
+        self.path = os.path.abspath(path)
+
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as fp:
+                self.manifest = json.load(fp)
+
+            if num_of_buckets not in (None, self.num_of_buckets):
+                raise ValueError(
+                    "{} has {} buckets, not {}".format(
+                        self.path, self.num_of_buckets, num_of_buckets
+                    )
+                )
+        else:
+            self.manifest = {
+                "num_of_buckets": num_of_buckets or DEFAULT_NUM_OF_BUCKETS,
+                "files": {},
+            }
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.path, "manifest.json")
+
+    @property
+    def num_of_buckets(self):
+        return self.manifest["num_of_buckets"]
+
+    def bucket_path(self, bucket):
+        return os.path.join(self.path, "buckets", "bucket_{:05d}.jsonl".format(bucket))
+
+    def spill_path(self, bucket):
+        return os.path.join(self.path, "spill", "bucket_{:05d}.jsonl".format(bucket))
+
+    def delta_path(self, bucket):
+        return os.path.join(self.path, "delta", "bucket_{:05d}.jsonl".format(bucket))
+
+    def _save_manifest(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(self.manifest, fp, indent=4, sort_keys=True)
+
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def file_signature(path):
+        st = os.stat(path)
+        return [st.st_size, int(st.st_mtime)]
+
+    def _spill(self, infiles):
+        spills = {}
+
+        try:
+            for infile in infiles:
+                with open(infile, "r") as fp:
+                    for l in fp:
+                        for key, appearance in appearances(l):
+                            bucket = bucket_of(key, self.num_of_buckets)
+                            if bucket not in spills:
+                                spills[bucket] = open(self.spill_path(bucket), "a")
+
+                            spills[bucket].write(
+                                "{}\n".format(
+                                    json.dumps([key, appearance], ensure_ascii=False)
+                                )
+                            )
+        finally:
+            for fp in spills.values():
+                fp.close()
+
+    @staticmethod
+    def _apply(persons, seen, path):
+        # adds the [key, appearance] lines of path to persons, returns the
+        # number of appearances that were not there yet
+        num_added = 0
+        try:
+            with open(path, "r") as fp:
+                for l in fp:
+                    try:
+                        key, appearance = json.loads(l)
+                    except ValueError:
+                        # the last line of an update that died while writing
+                        continue
+
+                    pid = person_id(key)
+                    if pid not in persons:
+                        persons[pid] = dict(
+                            zip(["person_id"] + KEY_FIELDS, [pid] + key),
+                            appearances=[],
+                        )
+
+                    if pid not in seen:
+                        seen[pid] = {
+                            _appearance_key(a) for a in persons[pid]["appearances"]
+                        }
+
+                    if _appearance_key(appearance) not in seen[pid]:
+                        seen[pid].add(_appearance_key(appearance))
+                        persons[pid]["appearances"].append(appearance)
+                        num_added += 1
+        except FileNotFoundError:
+            pass
+
+        return num_added
+
+    def _read_bucket(self, bucket, extra_paths=()):
+        # persons of a bucket with its delta applied, sorted by person_id.
+        # Returns the number of appearances added by extra_paths as well.
+        persons = {}
+        try:
+            with open(self.bucket_path(bucket), "r") as fp:
+                for l in fp:
+                    person = json.loads(l)
+                    persons[person["person_id"]] = person
+        except FileNotFoundError:
+            pass
+
+        # appearances of an input file indexed twice, e.g. after an update
+        # that died before saving the manifest, are only kept once
+        seen = {}
+        self._apply(persons, seen, self.delta_path(bucket))
+        num_added = sum(self._apply(persons, seen, path) for path in extra_paths)
+
+        if seen:
+            for pid in seen:
+                persons[pid]["appearances"].sort(key=_appearance_order)
+
+            persons = {pid: persons[pid] for pid in sorted(persons)}
+
+        return persons, num_added
+
+    def _compact(self, bucket):
+        # merges the delta and the spill of the bucket into it, returns the
+        # number of appearances added by the spill
+        persons, num_added = self._read_bucket(bucket, [self.spill_path(bucket)])
+
+        tmp_path = self.bucket_path(bucket) + ".tmp"
+        with open(tmp_path, "w") as fp:
+            for person in persons.values():
+                fp.write("{}\n".format(json.dumps(person, ensure_ascii=False)))
+
+        os.replace(tmp_path, self.bucket_path(bucket))
+        for path in [self.delta_path(bucket), self.spill_path(bucket)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+        return num_added
+
+    def _append(self, bucket):
+        # appends the spill of the bucket to its delta, appearances repeated
+        # within the spill are written once, returns the number written
+        seen = set()
+        with open(self.spill_path(bucket), "r") as f_in, open(
+            self.delta_path(bucket), "a"
+        ) as f_out:
+            for l in f_in:
+                try:
+                    key, appearance = json.loads(l)
+                except ValueError:
+                    continue
+
+                appearance_key = person_id(key), _appearance_key(appearance)
+                if appearance_key not in seen:
+                    seen.add(appearance_key)
+                    f_out.write(l)
+
+        os.remove(self.spill_path(bucket))
+        return len(seen)
+
+    def _needs_compaction(self, bucket):
+        delta_size = _file_size(self.delta_path(bucket)) + _file_size(
+            self.spill_path(bucket)
+        )
+        return delta_size > max(
+            self.min_compact_bytes,
+            self.compact_ratio * _file_size(self.bucket_path(bucket)),
+        )
+
+    def update(self, infiles, force=False):
+        # returns the input files that were indexed and the number of
+        # appearances added by them
+        for name in ["buckets", "delta", "spill"]:
+            os.makedirs(os.path.join(self.path, name), exist_ok=True)
+
+        new_files = [
+            os.path.abspath(f)
+            for f in infiles
+            if force
+            or self.manifest["files"].get(os.path.abspath(f)) != self.file_signature(f)
+        ]
+        # nothing is spilled when one of the files cannot be indexed
+        check_merged_files(new_files)
+
+        # Appearances of files indexed before are in the index already, the
+        # buckets they touch are compacted, which drops them. Appearances of
+        # new files are only checked against each other.
+        reindexed = any(f in self.manifest["files"] for f in new_files)
+
+        self._spill(new_files)
+
+        # spill files left over by an update that died are added as well
+        num_added = 0
+        for path in sorted(glob.glob(os.path.join(self.path, "spill", "*.jsonl"))):
+            bucket = int(re.search(r"bucket_(\d+)\.jsonl$", path).group(1))
+            if reindexed or self._needs_compaction(bucket):
+                num_added += self._compact(bucket)
+            else:
+                num_added += self._append(bucket)
+
+        for f in new_files:
+            self.manifest["files"][f] = self.file_signature(f)
+
+        self._save_manifest()
+        return new_files, num_added
+
+    def lookup(self, lastname, name, dob=None, city=None):
+        key = person_key({"lastname": lastname, "name": name, "dob": dob, "city": city})
+
+        persons, _ = self._read_bucket(bucket_of(key, self.num_of_buckets))
+        for person in persons.values():
+            if (person["lastname"], person["name"]) != key[:2]:
+                continue
+
+            if dob is not None and person["dob"] != key[2]:
+                continue
+
+            if city is not None and person["city"] != key[3]:
+                continue
+
+            yield person
+
+    def persons(self):
+        for bucket in range(self.num_of_buckets):
+            persons, _ = self._read_bucket(bucket)
+            yield from persons.values()
@@ -1,5 +1,6 @@
 # coding=utf-8
 import argparse
+import csv
 import glob
 import gzip
 import json
@@ -7,16 +8,43 @@ import json
 import os.path
 import random
 import re
+import sys
+import time
+import zlib
 from collections import defaultdict, Counter
-from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from itertools import chain
-from csv import DictWriter
 
-import prettytable
-from natsort import natsorted
 from tqdm import tqdm
 
+from dedup import DuplicateCollapser
+from dumpdiff import write_diff
+from filters import NoticeFilter, date_spec
+from fuzzymatch import FuzzyMatcher
+from inputcache import (
+    block_bytes,
+    open_cache,
+    read_blocks,
+    read_span,
+    span_size,
+    split_block,
+)
+from rawjson import NoOrigError, RawRecord, probe, project
+from officerindex import DEFAULT_NUM_OF_BUCKETS, OfficerIndex
 from registry_parser import parse_document, dob_regex
+from relocations import EDGE_FIELDS, RelocationGraph
+from sqlitesink import SQLiteSink, sink_spec
+from stats import StatsCollector
+from timeline import build_timeline
+from workqueue import WorkQueue, default_owner
+from workers import (
+    DEFAULT_START_METHOD,
+    START_METHODS,
+    SupervisedPool,
+    call_safely,
+    safe_map,
+    worker_context,
+)
 
 relocation_signs = [
     ("sitzverlegung", re.compile(r"\bsitzverlegung\b")),
@@ -30,35 +58,517 @@ relocation_signs = [
 signs_usage = defaultdict(int)
 
 
-def process_parsing_result(args, parsing_result, p_doc, stats):
-    notice_id = p_doc["notice_id"]
+def compute_stats(parsing_result, p_doc):
+    counts = Counter()
 
     if parsing_result:
-        stats[notice_id].update({k: len(v) for k, v in parsing_result.items()})
+        counts.update({k: len(v) for k, v in parsing_result.items()})
         possible_persons = dob_regex.findall(p_doc["full_text"])
 
         # only processing sitzverlegung for now
         possible_notices = relocation_signs[0][1].findall(p_doc["full_text"])
 
         if len(possible_persons) > len(parsing_result.get("officers", [])):
-            stats[notice_id]["might_have_unparsed_persons"] = 1
+            counts["might_have_unparsed_persons"] = 1
 
         if len(possible_notices) > len(
             list(
                 filter(lambda x: x["used_regex"], parsing_result.get("notices", []))
             )
         ):
-            stats[notice_id]["might_have_unparsed_relocations"] = 1
+            counts["might_have_unparsed_relocations"] = 1
 
         if "officers" not in parsing_result:
-            stats[notice_id]["got_no_persons"] = 1
+            counts["got_no_persons"] = 1
+
+        if any(
+            isinstance(e, dict) and e.get("kls") == "ParsingTimeout"
+            for e in parsing_result.get("errors", [])
+        ):
+            counts["timed_out"] = 1
+    else:
+        counts["got_no_persons"] = 1
+        counts["got_nothing"] = 1
+
+    return dict(counts)
+
+
+def partition_spec(value):
+    # "2/4" -> (2, 4)
+    try:
+        index, num_of_partitions = map(int, value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/N, got {}".format(value))
+
+    if not 1 <= index <= num_of_partitions:
+        raise argparse.ArgumentTypeError("i must be between 1 and N")
+
+    return index, num_of_partitions
+
+
+def partition_of(l, key, num_of_partitions):
+    try:
+        value = probe(l, key)
+    except ValueError:
+        # broken lines still end up in exactly one partition, to be reported
+        # there
+        value = l
+
+    return zlib.crc32(str(value).encode("utf-8")) % num_of_partitions + 1
+
+
+# fields of a notice used by parsing and stats, the rest only goes to the output
+NOTICE_FIELDS = ["notice_id", "federal_state", "event_type", "full_text"]
+# what the parent needs besides the line itself
+OUTPUT_FIELDS = ["notice_id", "federal_state"]
+
+
+def parse_json_and_document(l, time_budget=None, doc_filter=None):
+    doc = project(l, NOTICE_FIELDS + (doc_filter.keys if doc_filter else []))
+    # raw line probes of the parent are confirmed on the decoded notice
+    if doc_filter is not None and not doc_filter.matches(doc):
+        return None
+
+    # stats are computed here so the regexes run in workers, not in the parent
+    parsing_result, p_doc = parse_document(doc, time_budget=time_budget)
+    counts = compute_stats(parsing_result, p_doc)
+
+    # the notice goes back as the line it came in, instead of a dict of all
+    # of its fields
+    orig = RawRecord(l, {k: doc[k] for k in OUTPUT_FIELDS if k in doc})
+    return parsing_result, orig, counts
+
+
+def parse_span(span, cache_path, time_budget=None, doc_filter=None):
+    # workers slice the line out of their own mapping of the input cache, and
+    # only the span goes back with the output fields, not the line
+    res = parse_json_and_document(
+        read_span(cache_path, span), time_budget=time_budget, doc_filter=doc_filter
+    )
+    if res is None:
+        return None
+
+    parsing_result, orig, counts = res
+    return parsing_result, (span, dict(orig)), counts
+
+
+def parse_numbered(item, parse_line=None):
+    # items travel through the pool with the number of their input line,
+    # which only the parent needs for reporting
+    return parse_line(item[1])
+
+
+def parse_block(
+    block, time_budget=None, doc_filter=None, partition=None, partition_by=None
+):
+    # Lines of a block are decoded, split, filtered and parsed here, so that
+    # the parent does no work per line. Returns the number of the first line
+    # and (index of the line in the block, ok, result or (line, traceback))
+    first_line_no, data = block
+    parse_line = partial(
+        parse_json_and_document, time_budget=time_budget, doc_filter=doc_filter
+    )
+    results = []
+    for i, raw in enumerate(split_block(data)):
+        # a broken line is reported on its own, not with its whole block
+        ok, l = call_safely(bytes.decode, raw)
+        if not ok:
+            results.append((i, False, (raw.decode("utf-8", "replace"), l)))
+            continue
+
+        if partition is not None:
+            if partition_of(l, partition_by, partition[1]) != partition[0]:
+                continue
+
+        if doc_filter is not None and not doc_filter.matches_line(l):
+            results.append((i, True, None))
+            continue
+
+        ok, res = call_safely(parse_line, l)
+        results.append((i, ok, res if ok else (l, res)))
+
+    return first_line_no, results
+
+
+def merged_line(p_doc, parsing_result, orig_mode="full"):
+    if orig_mode == "ref":
+        return "{}\n".format(
+            json.dumps(
+                {
+                    "notice_id": p_doc["notice_id"],
+                    "federal_state": p_doc.get("federal_state"),
+                    "parsed": parsing_result,
+                },
+                ensure_ascii=False,
+                sort_keys=True,
+                default=str,
+            )
+        )
+
+    parsed = json.dumps(parsing_result, ensure_ascii=False, sort_keys=True, default=str)
+    if orig_mode == "raw":
+        # the input line is a json object already, it is spliced in as is
+        return '{{"orig": {}, "parsed": {}}}\n'.format(p_doc.line.rstrip(), parsed)
+
+    orig = json.dumps(p_doc.decode(), ensure_ascii=False, sort_keys=True, default=str)
+    return '{{"orig": {}, "parsed": {}}}\n'.format(orig, parsed)
+
+
+def parse_file(infile, outdir, args, cache=None, partition=None):
+    # infile holds (line_no, line) pairs, numbered before any filter, with a
+    # cache (line_no, (start, end)) spans of lines in it. With args.block_size
+    # it holds blocks of lines from read_blocks(), partition is then applied
+    # by the workers
+    read = cache.read if cache is not None else str
+    blocks = bool(args.block_size)
+
+    for f in glob.glob(os.path.join(outdir, "*.json")):
+        os.remove(f)
+
+    for f in glob.glob(os.path.join(outdir, "*.jsonlines")):
+        os.remove(f)
+
+    stats = StatsCollector(
+        outdir,
+        natural_order=args.stats_order == "natural",
+        max_txt_rows=args.stats_txt_rows,
+    )
+
+    pool = None
+    sink = None
+    if args.sink is not None:
+        sink = SQLiteSink.from_spec(args.sink, outdir)
+
+    if args.merge_results:
+        fp_merged = open(os.path.join(outdir, "merged.jsonlines"), "w")
+
+    fp_failed = open(os.path.join(outdir, "__failed.jsonlines"), "w")
+    num_failed = 0
+
+    collapser = None
+    if args.collapse_duplicates:
+        collapser = DuplicateCollapser(
+            OUTPUT_FIELDS, bloom_bits=args.duplicates_bloom_bits
+        )
+
+    def write_failed(line_no, l, error):
+        nonlocal num_failed
+        num_failed += 1
+
+        fp_failed.write(
+            "{}\n".format(
+                json.dumps(
+                    {
+                        "line_no": line_no,
+                        "orig": l.rstrip("\n"),
+                        "traceback": error,
+                    },
+                    ensure_ascii=False,
+                )
+            )
+        )
+        fp_failed.flush()
+
+    def quarantine(index, item, error):
+        line_no, l = item[0], read(item[1])
+        write_failed(line_no, l, error)
+
+        if collapser is not None:
+            for duplicate_line_no, duplicate in collapser.failed(line_no, l):
+                write_failed(duplicate_line_no, duplicate, error)
+
+    def quarantine_block(index, block, error):
+        # the worker died on the block, none of its lines can be told apart
+        first_line_no, data = block
+        for i, raw in enumerate(split_block(data)):
+            write_failed(first_line_no + i, raw.decode("utf-8", "replace"), error)
+
+    def unpack(results):
+        for first_line_no, block_results in results:
+            for i, ok, res in block_results:
+                if ok:
+                    yield res
+                else:
+                    write_failed(first_line_no + i, *res)
+
+    def respan(results):
+        # lines are sliced out of the mapping of the parent
+        for res in results:
+            if res is None:
+                yield res
+            else:
+                parsing_result, (span, fields), counts = res
+                yield parsing_result, RawRecord(cache.read(span), fields), counts
+
+    doc_filter = NoticeFilter.from_args(args) or None
+    num_skipped = 0
+
+    def prefilter(lines):
+        nonlocal num_skipped
+        for item in lines:
+            if doc_filter.matches_line(read(item[1])):
+                yield item
+            else:
+                num_skipped += 1
+
+    if doc_filter is not None and not blocks:
+        infile = prefilter(infile)
+
+    if collapser is not None:
+        infile = collapser.filter(infile, read)
+
+    if blocks:
+        parse_line = partial(
+            parse_block,
+            time_budget=args.time_budget,
+            doc_filter=doc_filter,
+            partition=partition,
+            partition_by=args.partition_by if partition is not None else None,
+        )
+    elif cache is not None:
+        parse_line = partial(
+            parse_numbered,
+            parse_line=partial(
+                parse_span,
+                cache_path=cache.path,
+                time_budget=args.time_budget,
+                doc_filter=doc_filter,
+            ),
+        )
     else:
-        stats[notice_id]["got_no_persons"] = 1
-        stats[notice_id]["got_nothing"] = 1
+        parse_line = partial(
+            parse_numbered,
+            parse_line=partial(
+                parse_json_and_document,
+                time_budget=args.time_budget,
+                doc_filter=doc_filter,
+            ),
+        )
 
+    if blocks:
+        item_size = block_bytes
+    elif cache is not None:
+        item_size = lambda item: span_size(item[1])
+    else:
+        item_size = lambda item: len(item[1])
+
+    on_failure = quarantine_block if blocks else quarantine
+    if args.num_of_workers == 1:
+        itr = safe_map(parse_line, infile, on_failure)
+    else:
+        pool = SupervisedPool(
+            parse_line,
+            args.num_of_workers,
+            on_failure,
+            batch_seconds=args.batch_seconds,
+            item_size=item_size,
+            max_tasks=args.max_tasks_per_worker,
+            max_rss=args.max_worker_rss * 2**20,
+            mp_context=worker_context(args.start_method),
+        )
+        itr = pool.imap(infile)
 
-def parse_json_and_document(l):
-    return parse_document(json.loads(l))
+    if blocks:
+        itr = unpack(itr)
+    elif cache is not None:
+        itr = respan(itr)
+
+    if collapser is not None:
+        itr = collapser.collapse(itr)
+
+    for res in tqdm(itr):
+        if res is None:
+            num_skipped += 1
+            continue
+
+        parsing_result, p_doc, counts = res
+        notice_id = p_doc["notice_id"]
+        federal_state = p_doc["federal_state"]
+        stats.add(notice_id, counts)
+
+        if sink is not None:
+            sink.add(p_doc, parsing_result)
+
+        if args.merge_results:
+            fp_merged.write(merged_line(p_doc, parsing_result, args.merged_orig))
+        elif sink is None:
+            if args.add_federal_state:
+                fname = os.path.join(
+                    outdir, "{}_{}.json".format(notice_id, federal_state)
+                )
+            else:
+                fname = os.path.join(outdir, "{}.json".format(notice_id))
+
+            with open(fname, "w") as fp:
+                json.dump(
+                    {"orig": p_doc.decode(), "parsed": parsing_result},
+                    fp,
+                    indent=4,
+                    ensure_ascii=False,
+                    sort_keys=True,
+                    default=str,
+                )
+
+    if pool is not None:
+        pool.close()
+
+    if sink is not None:
+        sink.close()
+
+    if args.merge_results:
+        fp_merged.close()
+
+    fp_failed.close()
+    if collapser is not None and collapser.num_of_duplicates:
+        print(
+            "{} notices with a duplicate text were parsed once".format(
+                collapser.num_of_duplicates
+            ),
+            file=sys.stderr,
+        )
+
+    if num_skipped:
+        print("{} notices skipped by filters".format(num_skipped), file=sys.stderr)
+
+    if num_failed:
+        print(
+            "{} notices failed to parse, see __failed.jsonlines".format(num_failed),
+            file=sys.stderr,
+        )
+
+    stats.close()
+
+
+def add_parsing_arguments(p):
+    p.add_argument(
+        "--federal_state",
+        nargs="+",
+        default=None,
+        help="Only parse notices of those federal states",
+    )
+    p.add_argument(
+        "--event_type",
+        nargs="+",
+        default=None,
+        help="Only parse notices of those event types, e.g. Löschungen",
+    )
+    p.add_argument(
+        "--since",
+        type=date_spec,
+        default=None,
+        help="Only parse notices posted on that day (YYYY-MM-DD) or later",
+    )
+    p.add_argument(
+        "--until",
+        type=date_spec,
+        default=None,
+        help="Only parse notices posted on that day (YYYY-MM-DD) or earlier",
+    )
+    p.add_argument(
+        "--add_federal_state",
+        action="store_true",
+        default=False,
+        help="Add federal state to the filenames when parsing",
+    )
+    p.add_argument(
+        "--num_of_workers",
+        type=int,
+        default=1,
+        help="Number of workers (1 to disable multithreading)",
+    )
+    p.add_argument(
+        "--merge_results",
+        action="store_true",
+        default=False,
+        help="Store results as a single file, called merged.jsonlines",
+    )
+    p.add_argument(
+        "--merged_orig",
+        choices=["full", "raw", "ref"],
+        default="full",
+        help="How merged.jsonlines stores the original notice: full (decoded "
+        "and re-encoded with sorted keys), raw (input line as is) or ref (only "
+        "notice_id and federal_state)",
+    )
+    p.add_argument(
+        "--sink",
+        type=sink_spec,
+        default=None,
+        help="Also load results into tables of sqlite:path.db (relative to "
+        "outdir, tables are recreated). No json files per notice are written "
+        "then, merged.jsonlines still is with --merge_results",
+    )
+    p.add_argument(
+        "--collapse_duplicates",
+        action="store_true",
+        default=False,
+        help="Parse notices with the same event_type and full_text once and "
+        "reuse the result, duplicates are counted as duplicate_text in stats",
+    )
+    p.add_argument(
+        "--duplicates_bloom_bits",
+        type=int,
+        default=0,
+        help="Remember texts seen by --collapse_duplicates in a bloom filter of "
+        "that many bits instead of a set, to bound memory (0 to use a set)",
+    )
+    p.add_argument(
+        "--time_budget",
+        type=float,
+        default=10,
+        help="CPU seconds a single notice may take, slower notices are recorded "
+        "as timed out (0 to disable). A single regex call is not interrupted, "
+        "the notice is cut short once it returns",
+    )
+    p.add_argument(
+        "--start_method",
+        choices=START_METHODS,
+        default=DEFAULT_START_METHOD,
+        help="How to start workers. forkserver and fork share the preloaded "
+        "parser between all of them",
+    )
+    p.add_argument(
+        "--batch_seconds",
+        type=float,
+        default=0.5,
+        help="Notices are sent to workers in batches sized by their length to "
+        "take about that many seconds each",
+    )
+    p.add_argument(
+        "--block_size",
+        type=int,
+        default=0,
+        help="Send workers raw blocks of about that many KB of input instead of "
+        "single notices, they decode, split and filter the lines on their own "
+        "(0 to disable)",
+    )
+    p.add_argument(
+        "--max_tasks_per_worker",
+        type=int,
+        default=50000,
+        help="Replace a worker after it parsed that many notices, or blocks with "
+        "--block_size (0 to disable)",
+    )
+    p.add_argument(
+        "--max_worker_rss",
+        type=int,
+        default=2048,
+        help="Replace a worker once its RSS grows over that many MB (0 to disable)",
+    )
+    p.add_argument(
+        "--stats_order",
+        choices=["natural", "arrival"],
+        default="natural",
+        help="Order of rows in __detailed_stats.csv: natural order of notice ids "
+        "(sorted on disk) or as parsed (written right away, repeated notice ids "
+        "are not summed up)",
+    )
+    p.add_argument(
+        "--stats_txt_rows",
+        type=int,
+        default=1000,
+        help="Max number of rows rendered into __detailed_stats.txt",
+    )
 
 
 if __name__ == "__main__":
@@ -93,6 +603,13 @@ if __name__ == "__main__":
     parser_sample.add_argument(
         "outfile", type=str, help="random sample of an input file"
     )
+    parser_sample.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Decompress infile once into that dir and read it from there, "
+        "memory-mapped, in this and later runs",
+    )
     parser_parse = subparsers.add_parser(
         "parse",
         help="Process input file and and store parsed results into outdir, json",
@@ -101,30 +618,303 @@ if __name__ == "__main__":
         "infile", help="Input file with company records, jsonlines, gzipped", type=str
     )
     parser_parse.add_argument(
-        "--add_federal_state",
+        "outdir", type=str, help="path to a dir to store results in. Will be wiped!!!"
+    )
+    parser_parse.add_argument(
+        "--partition",
+        type=partition_spec,
+        default=None,
+        help="Only parse partition i of N (e.g. 2/4), results and stats go to "
+        "outdir/partition_i_of_N. Combine the stats with merge-stats",
+    )
+    parser_parse.add_argument(
+        "--partition_by",
+        choices=["notice_id", "federal_state"],
+        default="notice_id",
+        help="Field that is hashed to assign notices to partitions",
+    )
+    parser_parse.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Decompress infile once into that dir and read it from there, "
+        "memory-mapped, in this and later runs",
+    )
+    add_parsing_arguments(parser_parse)
+    parser_merge_stats = subparsers.add_parser(
+        "merge-stats",
+        help="Combine stats of partitioned parse runs without re-parsing",
+    )
+    parser_merge_stats.add_argument(
+        "outdir", type=str, help="path to a dir to store combined stats in"
+    )
+    parser_merge_stats.add_argument(
+        "indirs",
+        nargs="*",
+        help="Dirs of partitioned runs, defaults to outdir/partition_*_of_*",
+    )
+    parser_merge_stats.add_argument(
+        "--stats_txt_rows",
+        type=int,
+        default=1000,
+        help="Max number of rows rendered into __detailed_stats.txt",
+    )
+    parser_queue_init = subparsers.add_parser(
+        "queue-init",
+        help="Split input file into shards of a work queue for parse workers",
+    )
+    parser_queue_init.add_argument(
+        "infile", help="Input file with company records, jsonlines, gzipped", type=str
+    )
+    parser_queue_init.add_argument(
+        "queue_dir", type=str, help="path to a dir to store the queue in"
+    )
+    parser_queue_init.add_argument(
+        "--shard_size", type=int, default=10000, help="Number of records per shard"
+    )
+    parser_queue_status = subparsers.add_parser(
+        "queue-status",
+        help="Report progress of a work queue, optionally requeue expired shards",
+    )
+    parser_queue_status.add_argument("queue_dir", type=str, help="path to the queue")
+    parser_queue_status.add_argument(
+        "--lease_ttl",
+        type=float,
+        default=600,
+        help="Seconds after which a claimed shard without heartbeat is expired",
+    )
+    parser_queue_status.add_argument(
+        "--requeue",
         action="store_true",
         default=False,
-        help="Add federal state to the filenames when parsing",
+        help="Put expired shards back to the queue",
     )
-    parser_parse.add_argument(
+    parser_worker = subparsers.add_parser(
+        "worker",
+        help="Claim shards from a work queue and parse them into queue_dir/results",
+    )
+    parser_worker.add_argument("queue_dir", type=str, help="path to the queue")
+    parser_worker.add_argument(
+        "--lease_ttl",
+        type=float,
+        default=600,
+        help="Seconds after which a claimed shard without heartbeat is expired",
+    )
+    parser_worker.add_argument(
+        "--max_shards",
+        type=int,
+        default=None,
+        help="Stop after parsing that many shards",
+    )
+    parser_worker.add_argument(
+        "--wait",
+        action="store_true",
+        default=False,
+        help="Keep polling while shards claimed by others are not done, they "
+        "might get requeued",
+    )
+    add_parsing_arguments(parser_worker)
+    parser_diff = subparsers.add_parser(
+        "diff",
+        help="Find new, changed and deleted notices between two dumps, the new "
+        "and changed ones are written to outdir/changed.json.gz for parse",
+    )
+    parser_diff.add_argument(
+        "old_infile", type=str, help="Previous dump, jsonlines, gzipped"
+    )
+    parser_diff.add_argument(
+        "new_infile", type=str, help="New dump, jsonlines, gzipped"
+    )
+    parser_diff.add_argument(
+        "outdir",
+        type=str,
+        help="path to a dir to store changed.json.gz and " "diff.jsonlines in",
+    )
+    parser_diff.add_argument(
+        "--run_size",
+        type=int,
+        default=1000000,
+        help="Notices sorted in memory before they are spilled to disk",
+    )
+    parser_officers_index = subparsers.add_parser(
+        "officers-index",
+        help="Add persons from officers of parsed results to a persistent index, "
+        "files indexed before are skipped",
+    )
+    parser_officers_index.add_argument(
+        "index_dir", type=str, help="path to the index, created if missing"
+    )
+    parser_officers_index.add_argument(
+        "infiles", nargs="+", type=str, help="merged.jsonlines files of parse runs"
+    )
+    parser_officers_index.add_argument(
+        "--num_of_buckets",
+        type=int,
+        default=None,
+        help="Number of buckets of a new index, a bucket has to fit into memory "
+        "(defaults to {}, an existing index keeps its own)".format(
+            DEFAULT_NUM_OF_BUCKETS
+        ),
+    )
+    parser_officers_index.add_argument(
+        "--force",
+        action="store_true",
+        default=False,
+        help="Index files again even if they did not change",
+    )
+    parser_officers_query = subparsers.add_parser(
+        "officers-query",
+        help="Find persons in an officers index and the notices they appear in",
+    )
+    parser_officers_query.add_argument("index_dir", type=str, help="path to the index")
+    parser_officers_query.add_argument("lastname", type=str)
+    parser_officers_query.add_argument("name", type=str)
+    parser_officers_query.add_argument(
+        "--dob", type=str, default=None, help="Date of birth, YYYY-MM-DD"
+    )
+    parser_officers_query.add_argument("--city", type=str, default=None)
+    parser_officers_match = subparsers.add_parser(
+        "officers-match",
+        help="Find persons of an officers index that are likely the same",
+    )
+    parser_officers_match.add_argument("index_dir", type=str, help="path to the index")
+    parser_officers_match.add_argument(
+        "outfile", type=str, help="matching pairs of persons, tab separated"
+    )
+    parser_officers_match.add_argument(
+        "--threshold",
+        type=float,
+        default=0.75,
+        help="Min similarity of names (0 to 1) for a pair to be reported",
+    )
+    parser_officers_match.add_argument(
+        "--max_block",
+        type=int,
+        default=1000,
+        help="Blocks of more persons than that are not compared",
+    )
+    parser_timeline = subparsers.add_parser(
+        "timeline",
+        help="Fold parsed results into the current state of every company, "
+        "sorted by register number",
+    )
+    parser_timeline.add_argument(
+        "outfile", type=str, help="one record per company, jsonlines"
+    )
+    parser_timeline.add_argument(
+        "infiles", nargs="+", type=str, help="merged.jsonlines files of parse runs"
+    )
+    parser_timeline.add_argument(
+        "--run_size",
+        type=int,
+        default=100000,
+        help="Notices sorted in memory before they are spilled to disk",
+    )
+    parser_relocation_graph = subparsers.add_parser(
+        "relocation-graph",
+        help="Join relocation notices into edges between old and new registers",
+    )
+    parser_relocation_graph.add_argument(
+        "outfile", type=str, help="edge list, tab separated"
+    )
+    parser_relocation_graph.add_argument(
+        "infiles", nargs="+", type=str, help="merged.jsonlines files of parse runs"
+    )
+    parser_relocation_graph.add_argument(
+        "--max_days",
+        type=int,
+        default=365,
+        help="Max days between the notices of both registers, when they are "
+        "matched on cities only",
+    )
+    parser_bench = subparsers.add_parser(
+        "bench",
+        help="Measure parsing throughput, startup time and memory on sample files",
+    )
+    parser_bench.add_argument(
+        "infiles",
+        nargs="*",
+        help="Input files with company records, jsonlines, gzipped (defaults to "
+        "sample1 and sample2 of samples)",
+    )
+    parser_bench.add_argument(
+        "--max_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Measure parse with 1, 2, 4... up to that number of workers",
+    )
+    parser_bench.add_argument(
+        "--limit", type=int, default=None, help="Number of records to benchmark on"
+    )
+    parser_bench.add_argument(
+        "--outfile",
+        type=str,
+        default="bench_output.json",
+        help="Where to store benchmark results, json",
+    )
+    parser_bench.add_argument(
+        "--compare",
+        type=str,
+        default=None,
+        help="Results of a previous run to check for regressions, json",
+    )
+    parser_bench.add_argument(
+        "--tolerance",
+        type=float,
+        default=10,
+        help="Slowdown (in percent) against --compare that is reported as regression",
+    )
+    parser_golden = subparsers.add_parser(
+        "golden",
+        help="Re-parse sample files and diff results against parsing_results",
+    )
+    parser_golden.add_argument(
+        "infiles",
+        nargs="*",
+        help="Input files with company records, jsonlines, gzipped (defaults to "
+        "all samples)",
+    )
+    parser_golden.add_argument(
+        "--reference_dir",
+        type=str,
+        default=None,
+        help="Dir with reference results, one subdir per sample file (defaults "
+        "to parsing_results)",
+    )
+    parser_golden.add_argument(
         "--num_of_workers",
         type=int,
-        default=1,
-        help="Number of workers (1 to disable multithreading)",
+        default=None,
+        help="Number of workers (defaults to number of cpus)",
     )
-    parser_parse.add_argument(
-        "outdir", type=str, help="path to a dir to store results in. Will be wiped!!!"
+    parser_golden.add_argument(
+        "--strict",
+        action="store_true",
+        default=False,
+        help="Do not normalize re.escape differences in flag texts",
     )
-    parser_parse.add_argument(
-        "--merge_results",
+    parser_golden.add_argument(
+        "--update",
         action="store_true",
         default=False,
-        help="Store results as a single file, called merged.jsonlines",
+        help="Overwrite reference results with the current output instead",
+    )
+    parser_golden.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="Store all discrepancies into that file, json",
     )
     args = parser.parse_args()
 
+    if getattr(args, "collapse_duplicates", False) and args.block_size:
+        parser.error("--collapse_duplicates does not work with --block_size")
+
     if args.operation == "sample":
-        infile = gzip.open(args.infile, "rt")
+        if args.cache_dir is not None:
+            infile = open_cache(args.infile, args.cache_dir)
+        else:
+            infile = gzip.open(args.infile, "rt")
         outfile = gzip.open(args.outfile, "wt")
 
         num_of_usual_records = round(
@@ -173,7 +963,9 @@ if __name__ == "__main__":
 
         print(signs_usage)
 
-        infile.seek(0)
+        if args.cache_dir is None:
+            infile.seek(0)
+
         prob_of_usual_rec = 2 * num_of_usual_records / num_lines
 
         with tqdm() as pbar:
@@ -195,92 +987,278 @@ if __name__ == "__main__":
             outfile.write(rec)
 
     elif args.operation == "parse":
-        stats = defaultdict(Counter)
         outdir = os.path.abspath(args.outdir)
-        infile = gzip.open(args.infile, "rt")
+        cache = None
+        if args.cache_dir is not None:
+            cache = open_cache(args.infile, args.cache_dir)
+            infile = enumerate(cache.spans())
+            read = cache.read
+        else:
+            infile = enumerate(gzip.open(args.infile, "rt"))
+            read = str
 
-        for f in glob.glob(os.path.join(outdir, "*.json")):
-            os.remove(f)
+        if args.block_size:
+            # blocks are cut from the cache as well, when there is one
+            if cache is not None:
+                fp = open(cache.path, "rb")
+            else:
+                fp = gzip.open(args.infile, "rb")
 
-        for f in glob.glob(os.path.join(outdir, "*.jsonlines")):
-            os.remove(f)
+            infile = read_blocks(fp, args.block_size * 1024)
+            cache = None
 
-        executor = None
-        if args.merge_results:
-            fp_merged = open(os.path.join(outdir, "merged.jsonlines"), "w")
+        if args.partition is not None:
+            partition, num_of_partitions = args.partition
+            outdir = os.path.join(
+                outdir, "partition_{}_of_{}".format(partition, num_of_partitions)
+            )
+            os.makedirs(outdir, exist_ok=True)
 
-        if args.num_of_workers == 1:
-            itr = map(parse_json_and_document, infile)
-        else:
-            executor = ProcessPoolExecutor(max_workers=args.num_of_workers)
-            itr = executor.map(parse_json_and_document, infile, chunksize=100)
-
-        for parsing_result, p_doc in tqdm(itr):
-            res = process_parsing_result(args, parsing_result, p_doc, stats)
-
-            notice_id = p_doc["notice_id"]
-            federal_state = p_doc["federal_state"]
-
-            if args.merge_results:
-                fp_merged.write(
-                    "{}\n".format(
-                        json.dumps(
-                            {"orig": p_doc, "parsed": parsing_result},
-                            ensure_ascii=False,
-                            sort_keys=True,
-                            default=str,
-                        )
-                    )
+        if args.partition is not None and not args.block_size:
+            infile = (
+                item
+                for item in infile
+                if partition_of(read(item[1]), args.partition_by, num_of_partitions)
+                == partition
+            )
+
+        parse_file(infile, outdir, args, cache=cache, partition=args.partition)
+
+    elif args.operation == "merge-stats":
+        outdir = os.path.abspath(args.outdir)
+        os.makedirs(outdir, exist_ok=True)
+        indirs = args.indirs or sorted(
+            glob.glob(os.path.join(outdir, "partition_*_of_*"))
+        )
+
+        partitions = defaultdict(set)
+        for indir in indirs:
+            m = re.search(r"partition_(\d+)_of_(\d+)$", indir.rstrip(os.sep))
+            if m:
+                partitions[int(m.group(2))].add(int(m.group(1)))
+
+        for num_of_partitions, found in partitions.items():
+            missing = set(range(1, num_of_partitions + 1)) - found
+            if missing:
+                print(
+                    "Partitions {} of {} are missing".format(
+                        ", ".join(map(str, sorted(missing))), num_of_partitions
+                    ),
+                    file=sys.stderr,
                 )
-            else:
-                if args.add_federal_state:
-                    fname = os.path.join(
-                        outdir, "{}_{}.json".format(notice_id, federal_state)
-                    )
+
+        stats = StatsCollector(outdir, max_txt_rows=args.stats_txt_rows)
+        for indir in indirs:
+            stats.add_detailed(os.path.join(indir, "__detailed_stats.csv"))
+
+        stats.close()
+
+    elif args.operation == "queue-init":
+        queue = WorkQueue(args.queue_dir)
+        print("{} shards created".format(queue.create(args.infile, args.shard_size)))
+
+    elif args.operation == "queue-status":
+        queue = WorkQueue(args.queue_dir)
+
+        if args.requeue:
+            for shard in queue.expired(args.lease_ttl):
+                if queue.requeue(shard):
+                    print("{} requeued".format(shard))
+
+        status = queue.status(args.lease_ttl)
+        print(
+            "todo: {todo}, claimed: {claimed} ({expired} expired), "
+            "done: {done}".format(**status)
+        )
+        for shard, owner in sorted(status["owners"].items()):
+            print("  {} is parsed by {}".format(shard, owner))
+
+    elif args.operation == "worker":
+        queue = WorkQueue(args.queue_dir)
+        owner = default_owner()
+        num_of_shards = 0
+
+        while args.max_shards is None or num_of_shards < args.max_shards:
+            shard = queue.claim(owner)
+            if shard is None:
+                if args.wait and queue.shards("claimed"):
+                    time.sleep(min(10, args.lease_ttl / 3.0))
+                    continue
+
+                break
+
+            work_dir = queue.work_dir(shard, owner)
+            os.makedirs(work_dir, exist_ok=True)
+
+            with queue.lease(shard, owner, args.lease_ttl):
+                path = queue.shard_path("claimed", shard)
+                if args.block_size:
+                    with gzip.open(path, "rb") as fp:
+                        parse_file(
+                            read_blocks(fp, args.block_size * 1024), work_dir, args
+                        )
                 else:
-                    fname = os.path.join(outdir, "{}.json".format(notice_id))
+                    with gzip.open(path, "rt") as infile:
+                        parse_file(enumerate(infile), work_dir, args)
 
-                with open(fname, "w") as fp:
-                    json.dump(
-                        {"orig": p_doc, "parsed": parsing_result},
-                        fp,
-                        indent=4,
-                        ensure_ascii=False,
-                        sort_keys=True,
-                        default=str,
-                    )
+            if queue.complete(shard, owner):
+                num_of_shards += 1
+            else:
+                print(
+                    "Lease on {} expired, results are discarded".format(shard),
+                    file=sys.stderr,
+                )
 
-        if executor is not None:
-            executor.shutdown()
+        print("{} shards parsed by {}".format(num_of_shards, owner))
 
-        if args.merge_results:
-            fp_merged.close()
+    elif args.operation == "diff":
+        os.makedirs(args.outdir, exist_ok=True)
+        counts = write_diff(
+            args.old_infile, args.new_infile, args.outdir, run_size=args.run_size
+        )
+        print(
+            "{new} new, {changed} changed, {deleted} deleted, {unchanged} "
+            "unchanged notices".format(**counts)
+        )
+        if counts["broken"]:
+            print("{} broken lines skipped".format(counts["broken"]), file=sys.stderr)
+
+    elif args.operation == "officers-index":
+        for infile in args.infiles:
+            if not os.path.isfile(infile):
+                parser.error("{} is not a file".format(infile))
+
+        try:
+            index = OfficerIndex(args.index_dir, num_of_buckets=args.num_of_buckets)
+        except ValueError as e:
+            parser.error(str(e))
+
+        try:
+            indexed, num_of_appearances = index.update(args.infiles, force=args.force)
+        except NoOrigError as e:
+            parser.error(str(e))
 
-        global_stats = Counter()
-        global_stats_headers = set()
+        print(
+            "{} files indexed, {} appearances of officers added".format(
+                len(indexed), num_of_appearances
+            )
+        )
 
-        for v in stats.values():
-            global_stats_headers |= set(v.keys())
+    elif args.operation == "officers-query":
+        index = OfficerIndex(args.index_dir)
+        for person in index.lookup(
+            args.lastname, args.name, dob=args.dob, city=args.city
+        ):
+            print(json.dumps(person, ensure_ascii=False))
 
-        fieldnames = ["notice_id"] + sorted(global_stats_headers)
+    elif args.operation == "officers-match":
+        matcher = FuzzyMatcher(max_block=args.max_block)
+        for person in OfficerIndex(args.index_dir).persons():
+            matcher.add(person)
 
-        with open(
-            os.path.join(outdir, "__detailed_stats.csv"), "w"
-        ) as f_detailed, open(
-            os.path.join(outdir, "__global_stats.json"), "w"
-        ) as f_global:
-            w = DictWriter(f_detailed, fieldnames=fieldnames)
-            w.writeheader()
+        with open(args.outfile, "w") as fp:
+            w = csv.writer(fp, delimiter="\t", lineterminator="\n")
+            w.writerow(
+                ["person_id_a", "person_id_b", "score"]
+                + ["lastname_a", "name_a", "dob_a", "lastname_b", "name_b", "dob_b"]
+            )
+            for a, b, score in matcher.matches(args.threshold):
+                w.writerow([a[0], b[0], round(score, 3)] + list(a[1:]) + list(b[1:]))
 
-            for k in natsorted(stats.keys()):
-                global_stats.update(stats[k])
-                row = {"notice_id": k}
-                row.update(stats[k])
-                w.writerow(row)
+        print(
+            "{persons} persons, {pairs} candidate pairs from {blocks} blocks "
+            "({skipped_blocks} too large)".format(**matcher.stats)
+        )
+
+    elif args.operation == "timeline":
+        try:
+            with open(args.outfile, "w") as fp:
+                num_of_companies, num_skipped = build_timeline(
+                    args.infiles, fp, run_size=args.run_size
+                )
+        except NoOrigError as e:
+            os.remove(args.outfile)
+            parser.error(str(e))
+
+        if num_skipped:
+            print(
+                "{} notices without amtsgericht or aktenzeichen skipped".format(
+                    num_skipped
+                ),
+                file=sys.stderr,
+            )
 
-            json.dump(global_stats, f_global, indent=4, sort_keys=True)
+        print("{} companies written".format(num_of_companies))
+
+    elif args.operation == "relocation-graph":
+        graph = RelocationGraph(max_days=args.max_days)
+        try:
+            graph.build(args.infiles)
+        except NoOrigError as e:
+            parser.error(str(e))
+
+        with open(args.outfile, "w") as fp:
+            w = csv.writer(fp, delimiter="\t", lineterminator="\n")
+            w.writerow(EDGE_FIELDS)
+            w.writerows(graph.edge_rows())
+
+        print("{} edges from {} relocations".format(len(graph.edges), len(graph.sides)))
+
+    elif args.operation == "bench":
+        # imported here, so that other operations do not pay for it
+        from benchmarks.throughput import (
+            DEFAULT_SAMPLES,
+            compare_reports,
+            format_report,
+            run_benchmarks,
+        )
+
+        report = run_benchmarks(
+            args.infiles or DEFAULT_SAMPLES, args.max_workers, limit=args.limit
+        )
+        print(format_report(report))
+
+        with open(args.outfile, "w") as fp:
+            json.dump(report, fp, indent=4, sort_keys=True)
+
+        if args.compare:
+            with open(args.compare, "r") as fp:
+                regressions = compare_reports(json.load(fp), report, args.tolerance)
+
+            for regression in regressions:
+                print("REGRESSION: {}".format(regression))
+
+            if regressions:
+                sys.exit(1)
+
+    elif args.operation == "golden":
+        # imported here, so that other operations do not pay for it
+        from benchmarks.golden import (
+            DEFAULT_REFERENCE_DIR,
+            DEFAULT_SAMPLES,
+            format_golden_report,
+            run_golden,
+        )
+
+        report = run_golden(
+            args.infiles or DEFAULT_SAMPLES,
+            reference_dir=args.reference_dir or DEFAULT_REFERENCE_DIR,
+            num_of_workers=args.num_of_workers,
+            strict=args.strict,
+            update=args.update,
+        )
+        print(format_golden_report(report))
+
+        if args.report:
+            with open(args.report, "w") as fp:
+                json.dump(
+                    report,
+                    fp,
+                    indent=4,
+                    ensure_ascii=False,
+                    sort_keys=True,
+                    default=str,
+                )
 
-        with open(os.path.join(outdir, "__detailed_stats.csv"), "r") as f_in, open(
-            os.path.join(outdir, "__detailed_stats.txt"), "w"
-        ) as f_out:
-            f_out.write(prettytable.from_csv(f_in).get_string())
+        if report["totals"]["different"]:
+            sys.exit(1)
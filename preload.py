@@ -0,0 +1,28 @@
+# coding=utf-8
+# Imported by the fork server before it forks any worker (and by the parent
+# itself for the fork start method), so that the tokenizer, the cities and the
+# compiled regexes are loaded once and shared by all workers
+import gc
+import re
+
+import registry_parser
+
+
+def warm_up():
+    # sentence rules are matched via re.search(str), which compiles lazily
+    # into the module cache of re
+    for sentence in registry_parser.sentences:
+        if isinstance(sentence.text, str):
+            re.compile(sentence.text, flags=re.I | re.U)
+
+
+def freeze():
+    # Everything allocated so far lives as long as the process. Moving it out
+    # of the collector's generations keeps the collector from writing to (and
+    # thus un-sharing) those pages in forked workers
+    gc.collect()
+    gc.freeze()
+
+
+warm_up()
+freeze()
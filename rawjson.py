@@ -0,0 +1,113 @@
+# coding=utf-8
+import json
+import re
+
+_key_regexes = {}
+_scalar_regex = re.compile(r"[^\s,\]}]+")
+
+
+def _key_regex(key):
+    if key not in _key_regexes:
+        # a quote inside of a json string is always escaped, so "key": can
+        # only be found at the key itself
+        _key_regexes[key] = re.compile(r'"{}"\s*:\s*'.format(re.escape(key)))
+
+    return _key_regexes[key]
+
+
+def value_span(line, key):
+    # start and end of the raw value of a top level key of a flat json line,
+    # None when the key is not there
+    m = _key_regex(key).search(line)
+    if m is None:
+        return None
+
+    start = end = m.end()
+    if not line.startswith('"', start):
+        m = _scalar_regex.match(line, start)
+        if m is None:
+            raise ValueError("No value for {} at {}".format(key, start))
+
+        return start, m.end()
+
+    while True:
+        end = line.find('"', end + 1)
+        if end == -1:
+            raise ValueError("Unterminated string for {} at {}".format(key, start))
+
+        # a quote after an odd number of backslashes is part of the string
+        backslashes = 0
+        while line[end - 1 - backslashes] == "\\":
+            backslashes += 1
+
+        if not backslashes % 2:
+            return start, end + 1
+
+
+def decode_value(raw):
+    if raw.startswith('"') and "\\" not in raw:
+        return raw[1:-1]
+
+    return json.loads(raw)
+
+
+def probe(line, key, default=None):
+    # value of a top level key of a json line, without decoding the rest of it
+    span = value_span(line, key)
+    if span is None:
+        return json.loads(line).get(key, default)
+
+    return decode_value(line[span[0] : span[1]])
+
+
+class RawRecord(dict):
+    # Requested fields of a json line, the line itself is kept as is for the
+    # output, so that the rest of it never has to be decoded
+    __slots__ = ["line"]
+
+    def __init__(self, line, fields):
+        super().__init__(fields)
+        self.line = line
+
+    def __reduce__(self):
+        return RawRecord, (self.line, dict(self))
+
+    def decode(self):
+        return json.loads(self.line)
+
+
+def project(line, keys):
+    # The C decoder beats value_span() once full_text is among the keys, so
+    # the line is decoded as a whole here, only the requested fields are kept
+    doc = json.loads(line)
+    return RawRecord(line, {k: doc[k] for k in keys if k in doc})
+
+
+class NoOrigError(ValueError):
+    pass
+
+
+def merged_orig(res):
+    # orig of a decoded line of merged.jsonlines, which parse --merged_orig ref
+    # leaves out
+    if "orig" not in res:
+        raise NoOrigError(
+            "merged results without orig (parse --merged_orig ref) cannot be "
+            "used, parse with --merged_orig full or raw"
+        )
+
+    return res["orig"]
+
+
+def check_merged_files(infiles):
+    # raises the NoOrigError of merged_orig() for the first line of every
+    # file, before any of them is processed
+    for infile in infiles:
+        with open(infile, "r") as fp:
+            l = fp.readline()
+
+        if l.strip():
+            try:
+                merged_orig(json.loads(l))
+            except NoOrigError as e:
+                raise NoOrigError("{}: {}".format(infile, e))
@@ -1,7 +1,10 @@
 # coding=utf-8
 import os.path
 import re
-from collections import defaultdict
+import signal
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict, defaultdict
 from itertools import chain
 
 from dateutil.parser import parse as dt_parse
@@ -16,6 +19,8 @@ _useful_regex = re.compile(r"\d{2}\.\d{2}\.\d{4}\n\n", flags=re.M)
 parse_number_regex = re.compile(r"^(\d+)\)?(.*)")
 gmbh_regex = re.compile(r"[\s-]g?mbh", flags=re.I)
 hrb_regex = re.compile(r"\b((?:HR\s?[AB]|VR|GnR|PR)\s?\d+)", flags=re.I)
+# İ, ı and ſ are the only chars where str.lower() disagrees with re.I matching
+_keyword_fold = str.maketrans({"\u0130": "i", "\u0131": "i", "\u017f": "s"})
 
 
 def simplify_city(city):
@@ -33,6 +38,10 @@ def simplify_city(city):
     )
 
 
+def fold_keyword(text):
+    return text.translate(_keyword_fold).lower()
+
+
 with open(os.path.join(os.path.dirname(__file__), "data/cities.txt"), "r") as fp:
     GERMAN_CITIES = list(map(simplify_city, fp))
 
@@ -41,6 +50,13 @@ class ParsingError(Exception):
     pass
 
 
+# Not a ParsingError on purpose: the except ParsingError of the rules must not
+# swallow it, or parsing goes on past the budget and half parsed sentences
+# end up in sentence_cache
+class ParsingTimeout(Exception):
+    pass
+
+
 class Flag(object):
     __slots__ = ["flag", "text"]
     kind = "flags"
@@ -407,34 +423,113 @@ class AppointedManagingDirector(FullPerson):
     kls = "AppointedManagingDirector"
 
 
-class AbstractNotice:
-    predecessor_regex = re.compile(r"bisher\s?\:?\s?(?:AG|Amtsgericht)", flags=re.I)
-    successor_regex = re.compile(
-        r"(jetzt|nun|nunmehr)\s?\:?\(?\s?(?:AG|Amtsgericht)", flags=re.I
+class NoticeAnchors(object):
+    __slots__ = [
+        "text",
+        "von",
+        "nach",
+        "new_seat",
+        "court",
+        "hr",
+        "successor",
+        "predecessor",
+    ]
+
+    # No two anchors can start at the same position, so one zero-width scan
+    # records the spans of all of them, overlapping ones included
+    anchor_regex = re.compile(
+        r"(?=(?P<von>\bvon\s+)"
+        r"|(?P<nach>nach(?=\W)\s*)"
+        r"|(?P<new_seat>\bNeuer\s+Sitz:?\s+)"
+        r"|(?P<court>\b(?:AG|Amtsgericht)\s+)"
+        r"|(?P<hr>(?:HR\s?[AB]|VR|GnR|PR)\s?\d+\s?\b[A-Z]{0,3}\b)"
+        r"|(?P<successor>(?:jetzt|nun|nunmehr)\s?\:?\(?\s?(?:AG|Amtsgericht))"
+        r"|(?P<predecessor>bisher\s?\:?\s?(?:AG|Amtsgericht)))",
+        flags=re.I,
     )
+    words_regex = re.compile(r"[^\s]*\s?[^\s]*\s?[^\s]*\s?[^\s]*\s?")
 
-    def identify_notice_type(self):
-        if self.successor_regex.search(self.text):
+    def __init__(self, text):
+        self.text = text
+        for kind in self.__slots__[1:]:
+            setattr(self, kind, [])
+
+        for m in self.anchor_regex.finditer(text):
+            getattr(self, m.lastgroup).append(m.span(m.lastgroup))
+
+    def at_word_start(self, pos):
+        return pos == 0 or not (
+            self.text[pos - 1].isalnum() or self.text[pos - 1] == "_"
+        )
+
+    def words(self, pos):
+        return self.words_regex.match(self.text, pos).group(0)
+
+    def bounded_hr(self):
+        # \b(HR...)
+        return [span for span in self.hr if self.at_word_start(span[0])]
+
+    def spaced_nach(self):
+        # \bnach\s+
+        return [
+            span
+            for span in self.nach
+            if span[1] > span[0] + 4 and self.at_word_start(span[0])
+        ]
+
+    def notice_type(self):
+        if self.successor:
             return "successor"
 
-        if self.predecessor_regex.search(self.text):
+        if self.predecessor:
             return "predecessor"
 
         return None
 
+
+class AbstractNotice:
+    def __init__(self, text):
+        self.text = text
+        self.anchors = NoticeAnchors(text)
+        self.positions = {}
+
+        self.payload = {
+            "used_regex": [],
+            "text": text,
+            "court": None,
+            "registration": self.anchors.notice_type(),
+        }
+
+    def set_field(self, field, value, position, used_regex=None):
+        self.payload[field] = value.strip()
+        self.positions[field] = position + len(value) - len(value.lstrip())
+
+        if used_regex is not None:
+            self.payload["used_regex"].append(used_regex)
+
+    def capture(self, field, value, position, used_regex):
+        if not value:
+            return False
+
+        self.set_field(field, value, position, used_regex)
+        return True
+
+    def capture_words(self, field, position, used_regex):
+        return self.capture(field, self.anchors.words(position), position, used_regex)
+
     def try_to_deduct_registration(self):
         if self.payload.get("court"):
-            court_position = self.text.index(self.payload["court"])
+            court_position = self.positions["court"]
             from_position = None
             to_position = None
 
             if "from" in self.payload:
-                from_position = self.text.index(self.payload["from"])
+                from_position = self.positions["from"]
                 if from_position > court_position:
                     from_position = None
 
             if "to" in self.payload:
-                to_position = self.text.index(self.payload["to"])
+                to_position = self.positions["to"]
                 if to_position > court_position:
                     to_position = None
 
@@ -479,56 +574,26 @@ class SuccessorRelocationNotice(AbstractNotice):
     kls = "SuccessorRelocationNotice"
     kind = "notices"
 
-    from_regex = re.compile(
-        r"\bvon\s+([^\s]*\s?[^\s]*\s?[^\s]*\s?[^\s]*\s?)", flags=re.I
-    )
-    hrb_regex = re.compile(
-        r"\b((?:HR\s?[AB]|VR|GnR|PR)\s?\d+\s?\b[A-Z]{0,3}\b)", flags=re.I
-    )
-
-    to_regex = re.compile(
-        r"\bnach\s+([^\s]*\s?[^\s]*\s?[^\s]*\s?[^\s]*\s?)", flags=re.I
-    )
-    to_regex2 = re.compile(
-        r"\bNeuer\s+Sitz:?\s+([^\s]*\s?[^\s]*\s?[^\s]*\s?[^\s]*\s?)", flags=re.I
-    )
-    court_regex = re.compile(
-        r"\b(?:AG|Amtsgericht)\s+([^\s]*\s?[^\s]*\s?[^\s]*\s?[^\s]*\s?)", flags=re.I
-    )
-
     def __init__(self, text, doc=None):
-        self.text = text
-        self.payload = {
-            "used_regex": [],
-            "text": text,
-            "court": None,
-            "registration": self.identify_notice_type(),
-        }
+        super().__init__(text)
+        anchors = self.anchors
 
-        matches = self.from_regex.search(text)
-        if matches and matches.group(1):
-            self.payload["from"] = matches.group(1).strip()
-            self.payload["used_regex"].append("from_regex")
+        # only the first anchor of a kind is taken into account
+        if anchors.von:
+            self.capture_words("from", anchors.von[0][1], "from_regex")
 
-        matches = self.hrb_regex.search(text)
-        if matches and matches.group(1):
-            self.payload["hrb"] = matches.group(1).strip()
-            self.payload["used_regex"].append("hrb_regex")
+        hr = anchors.bounded_hr()
+        if hr:
+            start, end = hr[0]
+            self.capture("hrb", text[start:end], start, "hrb_regex")
 
-        matches = self.to_regex.search(text)
-        if matches and matches.group(1):
-            self.payload["to"] = matches.group(1).strip()
-            self.payload["used_regex"].append("to_regex")
-        else:
-            matches = self.to_regex2.search(text)
-            if matches and matches.group(1):
-                self.payload["to"] = matches.group(1).strip()
-                self.payload["used_regex"].append("to_regex2")
+        nach = anchors.spaced_nach()
+        if not (nach and self.capture_words("to", nach[0][1], "to_regex")):
+            if anchors.new_seat:
+                self.capture_words("to", anchors.new_seat[0][1], "to_regex2")
 
-        matches = self.court_regex.search(text)
-        if matches and matches.group(1):
-            self.payload["court"] = matches.group(1).strip()
-            self.payload["used_regex"].append("court_regex")
+        if anchors.court:
+            self.capture_words("court", anchors.court[0][1], "court_regex")
 
         if self.payload["registration"] is None:
             self.try_to_deduct_registration()
@@ -544,76 +609,38 @@ class PredecessorRelocationNotice(AbstractNotice):
     kls = "PredecessorRelocationNotice"
     kind = "notices"
 
-    from_hrb_to_regex = re.compile(
-        r"\bvon\s+([^\(]+).*((?:HR\s?[AB]|VR|GnR|PR)\s?\d+\s?\b[A-Z]{0,3}\b).*nach\W([^\s]*\s?[^\s]*\s?[^\s]*\s?[^\s]*\s?)",
-        flags=re.I,
-    )
-
-    from_hrb_regex = re.compile(
-        r"\bvon\s+([^\(]+).*((?:HR\s?[AB]|VR|GnR|PR)\s?\d+\s?\b[A-Z]{0,3}\b)",
-        flags=re.I,
-    )
-    from_regex = re.compile(
-        r"\bvon\s+([^\s]*\s?[^\s]*\s?[^\s]*\s?[^\s]*\s?)", flags=re.I
-    )
-    hrb_regex = re.compile(
-        r"\b((?:HR\s?[AB]|VR|GnR|PR)\s?\d+\s?\b[A-Z]{0,3}\b)", flags=re.I
-    )
-    to_regex = re.compile(
-        r"\bnach\s+([^\s]*\s?[^\s]*\s?[^\s]*\s?[^\s]*\s?)", flags=re.I
-    )
-
-    court_regex = re.compile(
-        r"\b(?:AG|Amtsgericht)\s+([^\s]*\s?[^\s]*\s?[^\s]*\s?[^\s]*\s?)", flags=re.I
-    )
-
     def __init__(self, text, doc=None):
-        self.text = text
+        super().__init__(text)
+        anchors = self.anchors
 
-        self.payload = {
-            "used_regex": [],
-            "text": text,
-            "court": None,
-            "registration": self.identify_notice_type(),
-        }
-
-        court_matches = self.court_regex.search(text)
-        if court_matches and court_matches.group(1):
-            self.payload["court"] = court_matches.group(1).strip()
-            self.payload["used_regex"].append("court_regex")
+        if anchors.court:
+            self.capture_words("court", anchors.court[0][1], "court_regex")
 
-        matches = self.from_hrb_to_regex.search(text)
-        if matches:
-            self.payload["from"] = matches.group(1).strip()
-            self.payload["hrb"] = matches.group(2).strip()
-            self.payload["to"] = matches.group(3).strip()
+        fields = self.scan_from_hrb(with_to=True)
+        if fields:
+            for field in fields:
+                self.set_field(*field)
             self.payload["used_regex"].append("from_hrb_to_regex")
         else:
-            matches = self.from_hrb_regex.search(text)
-            if matches:
-                self.payload["from"] = matches.group(1).strip()
-                self.payload["hrb"] = matches.group(2).strip()
+            fields = self.scan_from_hrb(with_to=False)
+            if fields:
+                for field in fields:
+                    self.set_field(*field)
                 self.payload["used_regex"].append("from_hrb_regex")
-
-                matches = self.to_regex.search(text)
-                if matches:
-                    self.payload["to"] = matches.group(1).strip()
-                    self.payload["used_regex"].append("to_regex")
             else:
-                matches = self.from_regex.search(text)
-                if matches:
-                    self.payload["from"] = matches.group(1).strip()
-                    self.payload["used_regex"].append("from")
+                if anchors.von:
+                    position = anchors.von[0][1]
+                    self.set_field("from", anchors.words(position), position, "from")
 
-                matches = self.hrb_regex.search(text)
-                if matches:
-                    self.payload["hrb"] = matches.group(1).strip()
-                    self.payload["used_regex"].append("hrb")
+                hr = anchors.bounded_hr()
+                if hr:
+                    start, end = hr[0]
+                    self.set_field("hrb", text[start:end], start, "hrb")
 
-                matches = self.to_regex.search(text)
-                if matches:
-                    self.payload["to"] = matches.group(1).strip()
-                    self.payload["used_regex"].append("to_regex")
+            nach = anchors.spaced_nach()
+            if nach:
+                position = nach[0][1]
+                self.set_field("to", anchors.words(position), position, "to_regex")
 
         if self.payload["registration"] is None:
             self.try_to_deduct_registration()
@@ -624,6 +651,60 @@ class PredecessorRelocationNotice(AbstractNotice):
         ):
             self.payload["registration_conflict"] = True
 
+    def scan_from_hrb(self, with_to):
+        # Linear time version of von\s+([^\(]+).*(HRB...).*nach\W(...) and
+        # von\s+([^\(]+).*(HRB...): the greedy groups always end up on the last
+        # HR number (followed by a "nach", if required) and the last "nach".
+        # Texts come from _parse_normalized, so there are no newlines to stop
+        # the ".*" in between.
+        text = self.text
+        anchors = self.anchors
+
+        to_start = None
+        if with_to:
+            if not anchors.nach:
+                return None
+
+            to_start = anchors.nach[-1][0]
+
+        hrb = None
+        for span in anchors.hr:
+            if to_start is None or span[1] <= to_start:
+                hrb = span
+
+        if hrb is None:
+            return None
+
+        hrb_start, hrb_end = hrb
+        for von_start, from_start in anchors.von:
+            # from needs at least one char before the HR number. It starts
+            # with a whitespace given back by \s+ when that is the only way
+            if (
+                from_start < len(text)
+                and text[from_start] != "("
+                and hrb_start > from_start
+            ):
+                pass
+            elif from_start - von_start > 4 and hrb_start >= from_start:
+                from_start -= 1
+            else:
+                continue
+
+            from_end = text.find("(", from_start)
+            if from_end == -1 or from_end > hrb_start:
+                from_end = hrb_start
+
+            fields = [
+                ("from", text[from_start:from_end], from_start),
+                ("hrb", text[hrb_start:hrb_end], hrb_start),
+            ]
+            if with_to:
+                fields.append(("to", anchors.words(to_start + 5), to_start + 5))
+
+            return fields
+
+        return None
+
 
 class Sentence(object):
     __slots__ = [
@@ -632,6 +713,7 @@ class Sentence(object):
         "convert_to_flag",
         "assign_label_to_postfix",
         "capture_whole_text",
+        "keyword",
     ]
 
     def __init__(
@@ -641,12 +723,22 @@ class Sentence(object):
         convert_to_flag=None,
         assign_label_to_postfix=None,
         capture_whole_text=False,
+        keyword=None,
     ):
         if isinstance(text, str):
             self.text = re.escape(text)
+
+            if keyword is None:
+                keyword = max(re.findall(r"\w+", text), key=len, default="")
+                if len(keyword) < 3:
+                    keyword = text
         else:
             self.text = text
 
+        # Sentence can only match a chunk that contains its keyword,
+        # rules without one are always evaluated
+        self.keyword = fold_keyword(keyword) if keyword is not None else None
+
         self.split = split
         self.convert_to_flag = convert_to_flag
         self.assign_label_to_postfix = assign_label_to_postfix
@@ -772,6 +864,7 @@ sentences = [
     Sentence(
         re.compile(r"Prokura geändert(.*):", re.I),
         assign_label_to_postfix=NewProcuration,
+        keyword="Prokura geändert",
     ),
     Sentence("Inhaber:", assign_label_to_postfix=Owner),
     Sentence("Nicht mehr Inhaber:", assign_label_to_postfix=NotLongerOwner),
@@ -828,14 +921,17 @@ sentences = [
     Sentence(
         re.compile(r"\bSitzverlegung\b", flags=re.I),
         assign_label_to_postfix=PredecessorRelocationNotice,
+        keyword="Sitzverlegung",
     ),
     Sentence(
         re.compile(r"\bDer\s+Sitz\b", flags=re.I),
         assign_label_to_postfix=SuccessorRelocationNotice,
+        keyword="Sitz",
     ),
     Sentence(
         re.compile(r"\bSitz\s+verlegt\b", flags=re.I),
         assign_label_to_postfix=SuccessorRelocationNotice,
+        keyword="verlegt",
     ),
     Sentence("Der Inhaber handelt allein", convert_to_flag="The owner is acting alone"),
     Sentence("Kommanditgesellschaft.", convert_to_flag="Limited partnership."),
@@ -857,6 +953,36 @@ sentences = sorted(
 )
 
 
+# Rules grouped by keyword. The keywords are tested against the chunk one by
+# one with substring tests: with a few dozen of them that scan beats a lookup
+# of the words of the chunk in a dict, which has to handle keywords inside
+# words (prokura in einzelprokura) as well.
+class KeywordFilter(object):
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.always = set()
+        self.keywords = defaultdict(set)
+
+        for i, known_sentence in enumerate(sentences):
+            if known_sentence.keyword is None:
+                self.always.add(i)
+            else:
+                self.keywords[known_sentence.keyword].add(i)
+
+    def candidates(self, chunk):
+        folded = fold_keyword(chunk)
+        positions = set(self.always)
+
+        for keyword, keyword_positions in self.keywords.items():
+            if keyword in folded:
+                positions |= keyword_positions
+
+        return [self.sentences[i] for i in sorted(positions)]
+
+
+keyword_filter = KeywordFilter(sentences)
+
+
 def _parse_normalized(sents: tuple, doc: dict):
     for sent in [sents]:
         sent_had_persons = False
@@ -866,7 +992,7 @@ def _parse_normalized(sents: tuple, doc: dict):
 
             chunk_had_persons = False
             chunk_had_relocation = False
-            for known_sentence in sentences:
+            for known_sentence in keyword_filter.candidates(normalized):
                 res = list(filter(None, known_sentence.parse(normalized, doc)))
                 if res:
                     for r in res:
@@ -894,7 +1020,88 @@ def _parse_normalized(sents: tuple, doc: dict):
                     yield Error(type(e).__name__, str(e))
 
 
-def parse_document(doc: dict) -> (defaultdict, dict):
+def _copy_parsed(value):
+    if isinstance(value, dict):
+        return {k: _copy_parsed(v) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_copy_parsed(v) for v in value)
+
+    return value
+
+
+class SentenceCache(object):
+    def __init__(self, maxsize=50000, max_sentence_length=2000):
+        self.maxsize = maxsize
+        self.max_sentence_length = max_sentence_length
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+        self.evictions = 0
+
+    def get(self, sentence):
+        parsed = self.entries.get(sentence)
+        if parsed is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(sentence)
+
+        # callers get their own copy, so nothing they do reaches the cache
+        return _copy_parsed(parsed)
+
+    def put(self, sentence, parsed):
+        if self.maxsize <= 0 or len(sentence) > self.max_sentence_length:
+            self.uncacheable += 1
+            return
+
+        self.entries[sentence] = _copy_parsed(parsed)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = self.uncacheable = self.evictions = 0
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "uncacheable": self.uncacheable,
+            "evictions": self.evictions,
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+        }
+
+
+sentence_cache = SentenceCache()
+
+
+def _parse_sentence(sent: str, doc: dict) -> list:
+    parsed = sentence_cache.get(sent)
+    if parsed is not None:
+        return parsed
+
+    parsed = []
+    depends_on_doc = False
+    for v in _parse_normalized(sent, doc):
+        # only relocation notices look into the doc (event_type)
+        if isinstance(v, AbstractNotice):
+            depends_on_doc = True
+
+        parsed.append((v.kind, v.to_dict()))
+
+    if depends_on_doc:
+        sentence_cache.uncacheable += 1
+    else:
+        sentence_cache.put(sent, parsed)
+
+    return parsed
+
+
+def prepare_text(doc: dict) -> (str, list):
     errors = []
     text = doc.get("full_text", "")  # type: str
     event_type = doc.get("event_type", None)  # type: str
@@ -922,15 +1129,65 @@ def parse_document(doc: dict) -> (defaultdict, dict):
     useful_text = useful_text.replace(" Dipl.-Kfm", " Diplomkfm")
 
     useful_text = re.sub(r":\s(\d+)\.", r":\1)", useful_text)
-    sents = _german_tokenizer.tokenize(useful_text)  # type: tuple
-    res = defaultdict(list)
 
-    if errors:
-        res["errors"] = errors
+    return useful_text, errors
+
+
+def split_sentences(text: str) -> list:
+    return _german_tokenizer.tokenize(text)
+
 
-    for v in chain.from_iterable(
-        map(lambda x: _parse_normalized(x, doc), sents)
+def _raise_timeout(signum, frame):
+    raise ParsingTimeout("CPU time budget exceeded")
+
+
+@contextmanager
+def cpu_time_budget(seconds):
+    # SIGVTALRM fires after given seconds of CPU time spent by this process.
+    # Signal handlers can only be set from the main thread. The handler runs
+    # between bytecodes, so a long call into the C code of re is not cut
+    # short, the timeout is raised once the call returns.
+    if (
+        not seconds
+        or not hasattr(signal, "setitimer")
+        or threading.current_thread() is not threading.main_thread()
     ):
-        res[v.kind].append(v.to_dict())
+        yield
+        return
+
+    previous_handler = signal.signal(signal.SIGVTALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_VIRTUAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+        signal.signal(signal.SIGVTALRM, previous_handler)
+
+
+def parse_document(doc: dict, time_budget: float = None) -> (defaultdict, dict):
+    res = defaultdict(list)
+
+    try:
+        with cpu_time_budget(time_budget):
+            useful_text, errors = prepare_text(doc)
+            sents = split_sentences(useful_text)  # type: list
+
+            if errors:
+                res["errors"] = errors
+
+            for kind, v in chain.from_iterable(
+                map(lambda x: _parse_sentence(x, doc), sents)
+            ):
+                res[kind].append(v)
+    except ParsingTimeout as e:
+        res = defaultdict(list)
+        res["errors"].append(
+            Error(
+                type(e).__name__,
+                "Parsing of the notice took more than {} seconds of CPU time".format(
+                    time_budget
+                ),
+            ).to_dict()
+        )
 
     return res, doc
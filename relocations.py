@@ -0,0 +1,259 @@
+# coding=utf-8
+import datetime
+import json
+import re
+from collections import defaultdict
+
+from officerindex import normalise
+from rawjson import check_merged_files, merged_orig
+
+# Graph of company moves between registers, joined from the relocation
+# notices of parsed results. A relocation notice is published by one register
+# (amtsgericht, aktenzeichen of the notice) and names the other one, by court
+# and register number when it can, by cities otherwise. All joins go through
+# dicts keyed by normalised registers, register numbers or cities, so the
+# whole stage is two linear passes over the input plus the size of the
+# buckets, never a comparison of all pairs.
+#
+# Edges go from the old register to the new one, with a confidence:
+RECIPROCAL = 1.0  # both registers name each other
+KNOWN_REGISTER = 0.8  # the named register has notices of its own
+CLAIMED = 0.5  # only one side names the other, by register number
+CITY_PAIR = 0.4  # matched on cities and dates, no register number
+
+EDGE_FIELDS = [
+    "old_court",
+    "old_register",
+    "new_court",
+    "new_register",
+    "event_date",
+    "confidence",
+    "evidence",
+    "notice_ids",
+]
+
+_register_regex = re.compile(r"[^0-9a-z]+")
+
+
+def register_number(value):
+    # "HRB 23010 P" -> "hrb23010p"
+    return _register_regex.sub("", (value or "").lower())
+
+
+def court_name(value):
+    return normalise(value).strip(" -")
+
+
+def parse_date(value):
+    try:
+        return datetime.date.fromisoformat(value[:10])
+    except (TypeError, ValueError):
+        return None
+
+
+def relocation_sides(merged_line):
+    # register of the notice and relocations found in it
+    res = json.loads(merged_line)
+    orig = merged_orig(res)
+    register = (
+        court_name(orig.get("amtsgericht")),
+        register_number(orig.get("aktenzeichen")),
+    )
+    if not register[1]:
+        return register, orig, []
+
+    event_type = (orig.get("event_type") or "").lower()
+    sides = []
+    for relocation in res["parsed"].get("notices", []):
+        direction = {"successor": "old", "predecessor": "new"}.get(
+            relocation.get("registration")
+        )
+        if direction is None:
+            if event_type == "neueintragungen":
+                direction = "new"
+            elif event_type == "löschungen":
+                direction = "old"
+            elif court_name(relocation.get("to")).startswith(register[0]):
+                # moved here
+                direction = "new"
+            else:
+                direction = "old"
+
+        sides.append(
+            {
+                "register": register,
+                "notice_id": str(orig.get("notice_id")),
+                "event_date": orig.get("event_date"),
+                "direction": direction,
+                "other_court": court_name(relocation.get("court")),
+                "other_number": register_number(relocation.get("hrb")),
+                "other_name": (relocation.get("court") or "", relocation.get("hrb")),
+                "from": court_name(relocation.get("from")),
+                "to": court_name(relocation.get("to")),
+            }
+        )
+
+    return register, orig, sides
+
+
+class RelocationGraph(object):
+    def __init__(self, max_days=365):
+        self.max_days = max_days
+        self.sides = []
+        # display names of registers, from the notices that were published
+        # by them
+        self.names = {}
+        # registers named by some relocation that published notices
+        self.registers = set()
+        # courts by register number, for sides naming a number only
+        self.courts = defaultdict(set)
+        self.edges = {}
+
+    def add_sides(self, infiles):
+        for infile in infiles:
+            with open(infile, "r") as fp:
+                for l in fp:
+                    register, orig, sides = relocation_sides(l)
+                    if sides:
+                        self.names[register] = (
+                            orig["amtsgericht"],
+                            orig["aktenzeichen"],
+                        )
+                        self.sides.extend(sides)
+
+    def add_registers(self, infiles):
+        # only registers named by some relocation are kept, everything else
+        # is not needed for the joins
+        wanted = {side["other_number"] for side in self.sides if side["other_number"]}
+
+        for infile in infiles:
+            with open(infile, "r") as fp:
+                for l in fp:
+                    orig = merged_orig(json.loads(l))
+                    number = register_number(orig.get("aktenzeichen"))
+                    if number not in wanted:
+                        continue
+
+                    register = (court_name(orig.get("amtsgericht")), number)
+                    self.registers.add(register)
+                    self.courts[number].add(register[0])
+                    self.names.setdefault(
+                        register, (orig["amtsgericht"], orig["aktenzeichen"])
+                    )
+
+    def _other_register(self, side):
+        number = side["other_number"]
+        if side["other_court"]:
+            return side["other_court"], number
+
+        courts = self.courts.get(number, ())
+        if len(courts) == 1:
+            return next(iter(courts)), number
+
+        return "", number
+
+    def _add_edge(self, side, other, confidence, evidence, notice_ids):
+        if side["direction"] == "old":
+            key = side["register"], other
+        else:
+            key = other, side["register"]
+
+        edge = self.edges.get(key)
+        if edge is None or edge["confidence"] < confidence:
+            self.edges[key] = edge = {
+                "event_date": side["event_date"],
+                "confidence": confidence,
+                "evidence": evidence,
+                "notice_ids": set(),
+            }
+
+        edge["notice_ids"].update(notice_ids)
+
+    def _join_numbers(self):
+        by_register = defaultdict(list)
+        for side in self.sides:
+            by_register[side["register"]].append(side)
+
+        for side in self.sides:
+            if not side["other_number"]:
+                continue
+
+            other = self._other_register(side)
+            reciprocal = [
+                s
+                for s in by_register.get(other, [])
+                if s["other_number"] == side["register"][1]
+            ]
+
+            if reciprocal:
+                self._add_edge(
+                    side,
+                    other,
+                    RECIPROCAL,
+                    "reciprocal",
+                    [side["notice_id"]] + [s["notice_id"] for s in reciprocal],
+                )
+            elif other in self.registers:
+                self._add_edge(
+                    side, other, KNOWN_REGISTER, "register", [side["notice_id"]]
+                )
+            else:
+                self._add_edge(side, other, CLAIMED, "claim", [side["notice_id"]])
+
+            self.names.setdefault(other, side["other_name"])
+
+    def _join_cities(self):
+        # the old register says where to, the new one where from and to, so
+        # old sides are bucketed by (new seat, old seat), the old seat being
+        # the from of the notice or the court of the register, and looked up
+        # by the from and to of the new side
+        old_sides = defaultdict(list)
+        new_sides = []
+        for side in self.sides:
+            if side["other_number"] or not side["to"]:
+                continue
+
+            if side["direction"] == "old":
+                for seat in {side["from"], side["register"][0]} - {""}:
+                    old_sides[side["to"], seat].append(side)
+            elif side["from"]:
+                new_sides.append(side)
+
+        for side in new_sides:
+            date = parse_date(side["event_date"])
+            best = None
+            for candidate in old_sides.get((side["to"], side["from"]), []):
+                candidate_date = parse_date(candidate["event_date"])
+                if date is None or candidate_date is None:
+                    continue
+
+                days = abs((date - candidate_date).days)
+                if days <= self.max_days and (best is None or days < best[0]):
+                    best = days, candidate
+
+            if best is not None:
+                self._add_edge(
+                    side,
+                    best[1]["register"],
+                    CITY_PAIR,
+                    "cities",
+                    [side["notice_id"], best[1]["notice_id"]],
+                )
+
+    def build(self, infiles):
+        check_merged_files(infiles)
+        self.add_sides(infiles)
+        self.add_registers(infiles)
+        self._join_numbers()
+        self._join_cities()
+
+    def edge_rows(self):
+        for (old, new), edge in sorted(self.edges.items()):
+            yield [
+                *self.names[old],
+                *self.names[new],
+                edge["event_date"] or "",
+                edge["confidence"],
+                edge["evidence"],
+                ",".join(sorted(edge["notice_ids"])),
+            ]
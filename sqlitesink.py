@@ -0,0 +1,228 @@
+# coding=utf-8
+import argparse
+import os.path
+import queue
+import sqlite3
+import threading
+
+from rawjson import project
+
+# Normalised tables for the parsing results, every row carries notice_id and
+# federal_state of its notice
+TABLES = {
+    "notices": [
+        "notice_id",
+        "federal_state",
+        "amtsgericht",
+        "aktenzeichen",
+        "event_type",
+        "event_date",
+        "posted_on",
+        "name",
+    ],
+    "officers": [
+        "notice_id",
+        "federal_state",
+        "officer_no",
+        "class",
+        "dismissed",
+        "text",
+        "name",
+        "lastname",
+        "maidenname",
+        "prof_title",
+        "company_name",
+        "city",
+        "dob",
+        "position",
+        "flag",
+        "ref",
+    ],
+    "relocations": [
+        "notice_id",
+        "federal_state",
+        "relocation_no",
+        "registration",
+        "registration_conflict",
+        "registration_fuzzy",
+        "court",
+        "hrb",
+        "from_city",
+        "to_city",
+        "used_regex",
+        "text",
+    ],
+    "flags": ["notice_id", "federal_state", "flag", "text"],
+    "labels": ["notice_id", "federal_state", "label", "text"],
+}
+
+# built once the load is over, updating them on every insert is much slower
+INDEXES = {
+    "notices": [["notice_id", "federal_state"], ["amtsgericht", "aktenzeichen"]],
+    "officers": [["notice_id", "federal_state"], ["lastname", "name"], ["dob"]],
+    "relocations": [["notice_id", "federal_state"], ["court", "hrb"]],
+    "flags": [["notice_id", "federal_state"], ["flag"]],
+    "labels": [["notice_id", "federal_state"], ["label"]],
+}
+
+# payload keys of relocations that are sql keywords
+RELOCATION_COLUMNS = {"from_city": "from", "to_city": "to"}
+
+
+def sink_spec(value):
+    # "sqlite:path.db" -> ("sqlite", "path.db")
+    kind, _, path = value.partition(":")
+    if kind != "sqlite" or not path:
+        raise argparse.ArgumentTypeError(
+            "expected sqlite:path.db, got {}".format(value)
+        )
+
+    return kind, path
+
+
+def column_value(value):
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+
+    # dates of birth and the like
+    return str(value)
+
+
+def notice_rows(p_doc, parsing_result):
+    # the notice columns are decoded from the raw line here, in the writer
+    doc = project(p_doc.line, TABLES["notices"])
+    key = [doc.get("notice_id"), doc.get("federal_state")]
+
+    yield "notices", key + [column_value(doc.get(c)) for c in TABLES["notices"][2:]]
+
+    for i, officer in enumerate(parsing_result.get("officers", [])):
+        payload = officer["payload"]
+        yield "officers", key + [
+            i,
+            officer["class"],
+            int(bool(payload.get("dismissed"))),
+            officer["text"],
+        ] + [column_value(payload.get(c)) for c in TABLES["officers"][6:]]
+
+    for i, relocation in enumerate(parsing_result.get("notices", [])):
+        yield "relocations", key + [i] + [
+            column_value(relocation.get(RELOCATION_COLUMNS.get(c, c)))
+            for c in TABLES["relocations"][3:]
+        ]
+
+    for kind in ["flags", "labels"]:
+        for item in parsing_result.get(kind, []):
+            yield kind, key + [column_value(item.get(c)) for c in TABLES[kind][2:]]
+
+
+class SQLiteSink(object):
+    # Parsing results go through a queue to a writer thread, which inserts
+    # them in batches of batch_size rows per table and commits every
+    # transaction_size notices. Tables of a previous run are dropped first.
+    batch_size = 5000
+    transaction_size = 100000
+
+    def __init__(self, path, max_pending=10000):
+        self.path = path
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_spec(cls, spec, outdir):
+        # relative paths are put into outdir, so partitions get a db each
+        return cls(os.path.join(outdir, spec[1]))
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+
+        for table, columns in TABLES.items():
+            conn.execute("DROP TABLE IF EXISTS {}".format(table))
+            conn.execute("CREATE TABLE {} ({})".format(table, ", ".join(columns)))
+
+        conn.commit()
+        return conn
+
+    def _flush(self, conn, batches):
+        for table, rows in batches.items():
+            if rows:
+                conn.executemany(
+                    "INSERT INTO {} VALUES ({})".format(
+                        table, ", ".join("?" * len(TABLES[table]))
+                    ),
+                    rows,
+                )
+                rows.clear()
+
+    def _write(self):
+        try:
+            conn = self._connect()
+        except Exception as e:
+            self.error = e
+            conn = None
+
+        batches = {table: [] for table in TABLES}
+        in_transaction = 0
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            # once broken, the queue is still drained so that add() never
+            # blocks forever
+            if self.error is not None:
+                continue
+
+            try:
+                for table, row in notice_rows(*item):
+                    batches[table].append(row)
+                    if len(batches[table]) >= self.batch_size:
+                        self._flush(conn, {table: batches[table]})
+
+                in_transaction += 1
+                if in_transaction >= self.transaction_size:
+                    self._flush(conn, batches)
+                    conn.commit()
+                    in_transaction = 0
+            except Exception as e:
+                self.error = e
+
+        if conn is None:
+            return
+
+        try:
+            if self.error is None:
+                self._flush(conn, batches)
+                conn.commit()
+
+                for table, indexes in INDEXES.items():
+                    for columns in indexes:
+                        conn.execute(
+                            "CREATE INDEX {}_{} ON {} ({})".format(
+                                table, "_".join(columns), table, ", ".join(columns)
+                            )
+                        )
+
+                conn.commit()
+        except Exception as e:
+            self.error = e
+        finally:
+            conn.close()
+
+    def add(self, p_doc, parsing_result):
+        if self.error is not None:
+            raise self.error
+
+        self.queue.put((p_doc, parsing_result))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+        if self.error is not None:
+            raise self.error
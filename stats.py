@@ -0,0 +1,140 @@
+# coding=utf-8
+import csv
+import json
+import os.path
+from collections import Counter
+
+import prettytable
+from natsort import natsort_keygen
+
+from extsort import ExternalSorter, group_sorted
+
+# yes/no signals, a repeated notice_id keeps them at 1 instead of summing up
+FLAG_FIELDS = [
+    "might_have_unparsed_persons",
+    "might_have_unparsed_relocations",
+    "got_no_persons",
+    "got_nothing",
+    "timed_out",
+    "duplicate_text",
+]
+
+# every column that can appear in the detailed stats, used when rows have to
+# be written before all of them are seen
+STATS_FIELDS = ["errors", "flags", "labels", "notices", "officers"] + FLAG_FIELDS
+
+_natsort_key = natsort_keygen()
+
+
+def _row_key(row):
+    return _natsort_key(row[0])
+
+
+class StatsCollector(object):
+    def __init__(self, outdir, natural_order=True, run_size=100000, max_txt_rows=1000):
+        self.outdir = outdir
+        self.natural_order = natural_order
+        self.max_txt_rows = max_txt_rows
+        self.global_stats = Counter()
+        self.headers = set()
+
+        if natural_order:
+            self.sorter = ExternalSorter(key=_row_key, run_size=run_size)
+        else:
+            self.sorter = None
+            self.fp_detailed = open(self.detailed_path, "w")
+            self.writer = csv.DictWriter(
+                self.fp_detailed, fieldnames=["notice_id"] + sorted(STATS_FIELDS)
+            )
+            self.writer.writeheader()
+
+    @property
+    def detailed_path(self):
+        return os.path.join(self.outdir, "__detailed_stats.csv")
+
+    @property
+    def global_path(self):
+        return os.path.join(self.outdir, "__global_stats.json")
+
+    @property
+    def txt_path(self):
+        return os.path.join(self.outdir, "__detailed_stats.txt")
+
+    def add(self, notice_id, counts):
+        self.headers.update(counts.keys())
+
+        if self.natural_order:
+            self.sorter.add((notice_id, dict(counts)))
+        else:
+            self.global_stats.update(counts)
+            row = {"notice_id": notice_id}
+            row.update(counts)
+            self.writer.writerow(row)
+
+    def add_detailed(self, path):
+        # rows of a __detailed_stats.csv written by another run
+        with open(path, "r") as fp:
+            reader = csv.DictReader(fp)
+            self.headers.update(f for f in reader.fieldnames if f != "notice_id")
+
+            for row in reader:
+                notice_id = row.pop("notice_id")
+                self.add(notice_id, {k: int(v) for k, v in row.items() if v})
+
+    def _write_sorted(self):
+        fieldnames = ["notice_id"] + sorted(self.headers)
+
+        with open(self.detailed_path, "w") as fp:
+            w = csv.DictWriter(fp, fieldnames=fieldnames)
+            w.writeheader()
+
+            # same notice_id seen more than once is merged into one row
+            for notice_id, rows in group_sorted(self.sorter, key=lambda row: row[0]):
+                counts = Counter()
+                for _, row_counts in rows:
+                    for k, v in row_counts.items():
+                        if k in FLAG_FIELDS:
+                            counts[k] = max(counts[k], v)
+                        else:
+                            counts[k] += v
+
+                self.global_stats.update(counts)
+                row = {"notice_id": notice_id}
+                row.update(counts)
+                w.writerow(row)
+
+        self.sorter.close()
+
+    def _write_txt(self):
+        with open(self.detailed_path, "r") as f_in, open(self.txt_path, "w") as f_out:
+            reader = csv.reader(f_in)
+            table = prettytable.PrettyTable()
+            table.field_names = [x.strip() for x in next(reader)]
+
+            rendered = rest = 0
+            for row in reader:
+                if rendered < self.max_txt_rows:
+                    table.add_row([x.strip() for x in row])
+                    rendered += 1
+                else:
+                    rest += 1
+
+            f_out.write(table.get_string())
+
+            if rest:
+                f_out.write(
+                    "\n... {} more rows, see {}\n".format(
+                        rest, os.path.basename(self.detailed_path)
+                    )
+                )
+
+    def close(self):
+        if self.natural_order:
+            self._write_sorted()
+        else:
+            self.fp_detailed.close()
+
+        with open(self.global_path, "w") as f_global:
+            json.dump(self.global_stats, f_global, indent=4, sort_keys=True)
+
+        self._write_txt()
@@ -0,0 +1,163 @@
+# coding=utf-8
+import json
+
+from extsort import ExternalSorter, group_sorted
+from officerindex import normalise, person_key
+from rawjson import check_merged_files, merged_orig
+
+# Current state of every company, folded from its notices in the order of
+# their events. Notices are sorted by register (amtsgericht, aktenzeichen)
+# and event_date on disk first, so memory is bounded by the run size of the
+# sorter and by the notices of a single company.
+
+PROCURATION_CLASSES = {
+    "SingleProcuration",
+    "Procuration",
+    "NewProcuration",
+    "CommonProcuration",
+    "ProcurationCancelled",
+    "NotAProcurator",
+}
+
+ADDRESS_LABELS = ["address", "company"]
+
+# payload fields of an officer kept in the state
+OFFICER_FIELDS = ["lastname", "name", "dob", "city", "company_name", "position"]
+
+
+def sort_key(record):
+    return record[:5]
+
+
+def register_key(record):
+    return record[:2]
+
+
+def timeline_record(merged_line):
+    # (amtsgericht, aktenzeichen, event_date, posted_on, notice_id, notice) or
+    # None for notices without a register number, notice is what the fold
+    # needs of a line of merged.jsonlines
+    res = json.loads(merged_line)
+    orig = merged_orig(res)
+    if not orig.get("amtsgericht") or not orig.get("aktenzeichen"):
+        return None
+
+    parsed = res["parsed"]
+    notice = {
+        "name": orig.get("name"),
+        "officers": [
+            [
+                officer["class"],
+                bool(officer["payload"].get("dismissed")),
+                {
+                    f: officer["payload"][f]
+                    for f in OFFICER_FIELDS
+                    if officer["payload"].get(f) is not None
+                },
+            ]
+            for officer in parsed.get("officers", [])
+        ],
+        "addresses": [
+            label["text"].strip()
+            for label in parsed.get("labels", [])
+            if label["label"] in ADDRESS_LABELS
+        ],
+    }
+
+    return (
+        orig["amtsgericht"],
+        orig["aktenzeichen"],
+        orig.get("event_date") or "",
+        orig.get("posted_on") or "",
+        str(orig.get("notice_id")),
+        notice,
+    )
+
+
+def officer_key(payload):
+    if payload.get("lastname"):
+        return person_key(payload)
+
+    # companies acting as officers
+    return ("", normalise(payload.get("company_name")), "", "")
+
+
+def _dismiss(active, key):
+    if key in active:
+        del active[key]
+        return
+
+    # a dismissal often names the person without dob or city
+    for k in [k for k in active if k[:2] == key[:2]]:
+        del active[k]
+
+
+def fold(records):
+    # current state of a company from its sorted records
+    amtsgericht, aktenzeichen = register_key(records[0])
+    state = {
+        "amtsgericht": amtsgericht,
+        "aktenzeichen": aktenzeichen,
+        "name": None,
+        "address": None,
+        "first_event_date": records[0][2] or None,
+        "last_event_date": records[-1][2] or None,
+        "notice_ids": [],
+    }
+    officers = {}
+    procurations = {}
+
+    for _, _, event_date, _, notice_id, notice in records:
+        # the same notice parsed by more than one run is adjacent after sorting
+        if state["notice_ids"] and state["notice_ids"][-1] == notice_id:
+            continue
+
+        state["notice_ids"].append(notice_id)
+        if notice["name"]:
+            state["name"] = notice["name"]
+
+        if notice["addresses"]:
+            state["address"] = notice["addresses"][-1]
+
+        for kls, dismissed, payload in notice["officers"]:
+            active = procurations if kls in PROCURATION_CLASSES else officers
+            key = officer_key(payload)
+
+            if dismissed:
+                _dismiss(active, key)
+            else:
+                officer = {"class": kls, "since": event_date or None}
+                officer.update(payload)
+                officer["notice_id"] = notice_id
+                # the first appointment is kept when a person is repeated
+                if key in active:
+                    officer["since"] = active[key]["since"]
+
+                active[key] = officer
+
+    state["officers"] = list(officers.values())
+    state["procurations"] = list(procurations.values())
+    return state
+
+
+def build_timeline(infiles, fp_out, run_size=100000, tmpdir=None):
+    # writes a json line per company to fp_out, returns the number of
+    # companies and of notices without a register number
+    num_of_companies = num_skipped = 0
+    check_merged_files(infiles)
+
+    with ExternalSorter(key=sort_key, run_size=run_size, tmpdir=tmpdir) as sorter:
+        for infile in infiles:
+            with open(infile, "r") as fp:
+                for l in fp:
+                    record = timeline_record(l)
+                    if record is None:
+                        num_skipped += 1
+                    else:
+                        sorter.add(record)
+
+        for _, records in group_sorted(sorter, key=register_key):
+            fp_out.write("{}\n".format(json.dumps(fold(records), ensure_ascii=False)))
+            num_of_companies += 1
+
+    return num_of_companies, num_skipped
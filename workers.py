@@ -0,0 +1,359 @@
+# coding=utf-8
+import importlib
+import multiprocessing
+import os
+import resource
+import time
+import traceback
+from collections import deque
+from multiprocessing.connection import wait
+
+START_METHODS = multiprocessing.get_all_start_methods()
+DEFAULT_START_METHOD = (
+    "forkserver"
+    if "forkserver" in START_METHODS
+    else multiprocessing.get_start_method()
+)
+
+
+def current_rss():
+    # in bytes, falls back to the peak on systems without procfs
+    try:
+        with open("/proc/self/statm", "r") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def worker_context(start_method, preload="preload"):
+    ctx = multiprocessing.get_context(start_method)
+
+    if start_method == "forkserver":
+        # __main__ goes first, so workers do not have to import it on their own
+        ctx.set_forkserver_preload(["__main__", preload])
+    elif start_method == "fork":
+        importlib.import_module(preload)
+
+    return ctx
+
+
+def call_safely(func, item):
+    try:
+        return True, func(item)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def safe_map(func, items, on_failure):
+    # in-process counterpart of SupervisedPool.imap
+    for index, item in enumerate(items):
+        ok, res = call_safely(func, item)
+        if ok:
+            yield res
+        else:
+            on_failure(index, item, res)
+
+
+def _worker_loop(conn, func, max_tasks, max_rss):
+    done = 0
+    parent = os.getppid()
+    while True:
+        # pipe ends are inherited by sibling workers, so a dead parent does not
+        # always show up as EOF
+        while not conn.poll(1):
+            if os.getppid() != parent:
+                return
+
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+
+        if task is None:
+            break
+
+        started = time.perf_counter()
+        results = []
+        retire = False
+        for item in task:
+            results.append(call_safely(func, item))
+            done += 1
+
+            # limits are checked after every item, a worker that reaches one
+            # stops in the middle of a batch, the parent sends the rest of it
+            # to another worker
+            if (max_tasks and done >= max_tasks) or (
+                max_rss and current_rss() > max_rss
+            ):
+                retire = True
+                break
+
+        elapsed = time.perf_counter() - started
+
+        # results of the last batch are sent before retiring, so the parent
+        # never has to tell a retired worker from a crashed one
+        conn.send((results, retire, elapsed))
+
+        if retire:
+            break
+
+    conn.close()
+
+
+class Worker(object):
+    def __init__(self, ctx, func, max_tasks, max_rss):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_loop, args=(child_conn, func, max_tasks, max_rss)
+        )
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.task = None
+
+    def send(self, task):
+        self.task = task
+        self.conn.send(task[-1])
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+
+        self.conn.close()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+
+# Ordered map over a pool of processes that survives misbehaving items.
+# Exceptions raised by func are reported to on_failure with the traceback and
+# the rest of the batch is unaffected. When a worker dies on a batch (segfault,
+# OOM killer) the batch is retried one item at a time, so only the item that
+# kills the worker again is reported. Workers are replaced after max_tasks
+# items or once their RSS passes max_rss bytes.
+#
+# Batches are cut by the cumulative item_size of their items, which is
+# adapted so that a batch takes about batch_seconds in a worker. An item that
+# alone takes up more than outlier_share of that gets a batch of its own, so it
+# does not hold up the items around it.
+class SupervisedPool(object):
+    min_batch_bytes = 2**12
+    max_batch_bytes = 2**24
+    outlier_share = 0.25
+
+    def __init__(
+        self,
+        func,
+        num_of_workers,
+        on_failure,
+        batch_size=1000,
+        batch_seconds=0.5,
+        item_size=len,
+        max_tasks=None,
+        max_rss=None,
+        mp_context=None,
+    ):
+        self.func = func
+        self.num_of_workers = num_of_workers
+        self.on_failure = on_failure
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.item_size = item_size
+        self.batch_bytes = 2**18
+        self.seconds_per_byte = None
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.ctx = mp_context or multiprocessing.get_context()
+        self.workers = []
+        self.stats = {
+            "batches": 0,
+            "outliers": 0,
+            "retried": 0,
+            "failed": 0,
+            "recycled": 0,
+        }
+
+    def _spawn(self):
+        worker = Worker(self.ctx, self.func, self.max_tasks, self.max_rss)
+        self.workers.append(worker)
+
+        return worker
+
+    def _retire(self, worker):
+        self.workers.remove(worker)
+        worker.stop()
+
+    def _batches(self, items):
+        batch = []
+        batch_bytes = 0
+
+        for item in items:
+            size = self.item_size(item)
+            outlier = size >= self.outlier_share * self.batch_bytes
+
+            if batch and (
+                outlier
+                or len(batch) >= self.batch_size
+                or batch_bytes + size > self.batch_bytes
+            ):
+                yield batch
+                batch = []
+                batch_bytes = 0
+
+            if outlier:
+                self.stats["outliers"] += 1
+                yield [item]
+                continue
+
+            batch.append(item)
+            batch_bytes += size
+
+        if batch:
+            yield batch
+
+    def _adapt(self, batch, elapsed):
+        seconds_per_byte = elapsed / max(1, sum(map(self.item_size, batch)))
+        if self.seconds_per_byte is None:
+            self.seconds_per_byte = seconds_per_byte
+        else:
+            self.seconds_per_byte = 0.8 * self.seconds_per_byte + 0.2 * seconds_per_byte
+
+        if self.seconds_per_byte > 0:
+            self.batch_bytes = int(
+                min(
+                    max(
+                        self.batch_seconds / self.seconds_per_byte,
+                        self.min_batch_bytes,
+                    ),
+                    self.max_batch_bytes,
+                )
+            )
+
+    def imap(self, items):
+        batches = self._batches(items)
+        # task is (batch_no, offset, first_index, items), results of a batch
+        # are collected into slots until all of them are filled
+        queue = deque()
+        slots = {}
+        missing = {}
+        next_batch = 0
+        next_yield = 0
+        first_index = 0
+        exhausted = False
+        max_pending = 4 * self.num_of_workers
+
+        while len(self.workers) < self.num_of_workers:
+            self._spawn()
+
+        while True:
+            while next_yield in slots and not missing[next_yield]:
+                for res in slots.pop(next_yield):
+                    if res:
+                        yield res[0]
+
+                del missing[next_yield]
+                next_yield += 1
+
+            while not exhausted and len(slots) < max_pending:
+                batch = next(batches, None)
+                if batch is None:
+                    exhausted = True
+                    break
+
+                slots[next_batch] = [None] * len(batch)
+                missing[next_batch] = len(batch)
+                queue.append((next_batch, 0, first_index, batch))
+                next_batch += 1
+                first_index += len(batch)
+                self.stats["batches"] += 1
+
+            for worker in self.workers:
+                if worker.task is None and queue:
+                    worker.send(queue.popleft())
+
+            if exhausted and not slots:
+                break
+
+            busy = [w for w in self.workers if w.task is not None]
+            ready = wait([w.conn for w in busy] + [w.process.sentinel for w in busy])
+
+            for worker in busy:
+                if worker.conn not in ready and worker.process.sentinel not in ready:
+                    continue
+
+                batch_no, offset, index, batch = worker.task
+                if worker.conn.poll():
+                    try:
+                        results, retire, elapsed = worker.conn.recv()
+                    except EOFError:
+                        results, retire = None, True
+                else:
+                    results, retire = None, not worker.process.is_alive()
+                    if not retire:
+                        continue
+
+                worker.task = None
+
+                if results is None:
+                    # joined first, the exit code is not known before
+                    self._retire(worker)
+                    exitcode = worker.process.exitcode
+                    self._spawn()
+
+                    if len(batch) > 1:
+                        self.stats["retried"] += 1
+                        # appended to the front, so the ordered output does
+                        # not wait behind the rest of the queue
+                        queue.extendleft(
+                            reversed(
+                                [
+                                    (batch_no, offset + i, index + i, [item])
+                                    for i, item in enumerate(batch)
+                                ]
+                            )
+                        )
+                        continue
+
+                    self.stats["failed"] += 1
+                    self.on_failure(
+                        index,
+                        batch[0],
+                        "Worker died with exit code {} while processing "
+                        "the item".format(exitcode),
+                    )
+                    results = [(False, None)]
+                else:
+                    if len(results) < len(batch):
+                        # the worker retired in the middle of the batch
+                        n = len(results)
+                        queue.appendleft((batch_no, offset + n, index + n, batch[n:]))
+                        batch = batch[:n]
+
+                    self._adapt(batch, elapsed)
+
+                    if retire:
+                        self.stats["recycled"] += 1
+                        self._retire(worker)
+                        self._spawn()
+
+                    for i, (ok, res) in enumerate(results):
+                        if not ok:
+                            self.stats["failed"] += 1
+                            self.on_failure(index + i, batch[i], res)
+
+                for i, (ok, res) in enumerate(results):
+                    slots[batch_no][offset + i] = (res,) if ok else False
+                missing[batch_no] -= len(results)
+
+    def close(self):
+        for worker in list(self.workers):
+            self._retire(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,207 @@
+# coding=utf-8
+import gzip
+import json
+import os
+import os.path
+import shutil
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from itertools import islice
+
+# Layout of a queue dir, a shard moves between the first three dirs by
+# atomic renames, so exactly one worker can claim it:
+#   todo/shard_00001.json.gz     waiting to be parsed
+#   claimed/shard_00001.json.gz  being parsed
+#   done/shard_00001.json.gz     parsed
+#   leases/shard_00001.json.gz   owner of a claimed shard, mtime is renewed
+#                                by the owner as long as it is alive
+#   results/shard_00001/         output of parse for the shard, written to
+#                                results/.shard_00001.<owner> first
+STATES = ["todo", "claimed", "done"]
+
+
+def default_owner():
+    return "{}_{}".format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def dir(self, name):
+        return os.path.join(self.path, name)
+
+    def shard_path(self, state, shard):
+        return os.path.join(self.dir(state), shard)
+
+    def lease_path(self, shard):
+        return os.path.join(self.dir("leases"), shard)
+
+    def results_dir(self, shard):
+        return os.path.join(self.dir("results"), shard.split(".", 1)[0])
+
+    def work_dir(self, shard, owner):
+        return os.path.join(
+            self.dir("results"), ".{}.{}".format(shard.split(".", 1)[0], owner)
+        )
+
+    def shards(self, state):
+        try:
+            return sorted(
+                f for f in os.listdir(self.dir(state)) if not f.startswith(".")
+            )
+        except FileNotFoundError:
+            return []
+
+    def create(self, infile, shard_size):
+        for name in STATES + ["leases", "results"]:
+            os.makedirs(self.dir(name), exist_ok=True)
+
+        if any(self.shards(state) for state in STATES):
+            raise ValueError("Queue {} is not empty".format(self.path))
+
+        num_of_shards = 0
+        with gzip.open(infile, "rt") as fp:
+            while True:
+                lines = list(islice(fp, shard_size))
+                if not lines:
+                    break
+
+                num_of_shards += 1
+                shard = "shard_{:05d}.json.gz".format(num_of_shards)
+                # written under a hidden name, so no worker sees half a shard
+                tmp_path = self.shard_path("todo", "." + shard)
+                with gzip.open(tmp_path, "wt", compresslevel=1) as fp_shard:
+                    fp_shard.writelines(lines)
+
+                os.rename(tmp_path, self.shard_path("todo", shard))
+
+        return num_of_shards
+
+    def claim(self, owner):
+        for shard in self.shards("todo"):
+            try:
+                os.rename(
+                    self.shard_path("todo", shard), self.shard_path("claimed", shard)
+                )
+            except FileNotFoundError:
+                # somebody else was faster
+                continue
+
+            self.renew(shard, owner)
+            return shard
+
+        return None
+
+    def renew(self, shard, owner):
+        tmp_path = os.path.join(self.dir("leases"), ".{}.{}".format(shard, owner))
+        with open(tmp_path, "w") as fp:
+            json.dump({"owner": owner, "renewed_at": time.time()}, fp)
+
+        os.replace(tmp_path, self.lease_path(shard))
+
+    def owner(self, shard):
+        try:
+            with open(self.lease_path(shard), "r") as fp:
+                return json.load(fp)["owner"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @contextmanager
+    def lease(self, shard, owner, ttl):
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(ttl / 3.0):
+                if self.owner(shard) != owner:
+                    break
+
+                self.renew(shard, owner)
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, shard, owner):
+        # False when the lease has expired and the shard went back to todo
+        # in the meantime, the next owner is going to write the results then
+        work_dir = self.work_dir(shard, owner)
+        if self.owner(shard) != owner:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return False
+
+        # moving the shard to done is the commit point, the results are only
+        # published once it succeeded, so a worker that lost the shard never
+        # touches the results of the next owner
+        try:
+            os.rename(self.shard_path("claimed", shard), self.shard_path("done", shard))
+        except FileNotFoundError:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return False
+
+        results_dir = self.results_dir(shard)
+        shutil.rmtree(results_dir, ignore_errors=True)
+        os.rename(work_dir, results_dir)
+
+        self.release(shard)
+        return True
+
+    def release(self, shard):
+        try:
+            os.remove(self.lease_path(shard))
+        except FileNotFoundError:
+            pass
+
+    def last_seen(self, shard):
+        # a claim renames the shard, which updates its ctime, so a shard
+        # whose owner died before writing the lease expires as well
+        seen = []
+        for path in [self.lease_path(shard), self.shard_path("claimed", shard)]:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            seen.append(max(st.st_mtime, st.st_ctime))
+
+        return max(seen) if seen else None
+
+    def expired(self, ttl):
+        now = time.time()
+        res = []
+        for shard in self.shards("claimed"):
+            seen = self.last_seen(shard)
+            if seen is not None and now - seen > ttl:
+                res.append(shard)
+
+        return res
+
+    def requeue(self, shard):
+        try:
+            os.rename(self.shard_path("claimed", shard), self.shard_path("todo", shard))
+        except FileNotFoundError:
+            return False
+
+        self.release(shard)
+        return True
+
+    def status(self, ttl):
+        expired = set(self.expired(ttl))
+        return {
+            "todo": len(self.shards("todo")),
+            "claimed": len(self.shards("claimed")),
+            "done": len(self.shards("done")),
+            "expired": len(expired),
+            "owners": {
+                shard: self.owner(shard)
+                for shard in self.shards("claimed")
+                if shard not in expired
+            },
+        }